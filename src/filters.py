@@ -0,0 +1,302 @@
+import math
+import time
+from jobs import (read_index, index_generation, catalog_size, iter_planets, fetch_planets, category_index_key,
+                  range_index_key, CATEGORY_INDEX_FIELDS, RANGE_INDEX_FIELDS)
+
+# Operators that can appear in a filter expression. Each leaf is a dictionary such as
+#   {'field': 'discoverymethod', 'op': 'eq', 'value': 'Transit'}
+#   {'field': 'hostname', 'op': 'in', 'values': ['TOI-332', 'K2-18']}
+#   {'field': 'pl_rade', 'op': 'range', 'min': 1, 'max': 2}
+#   {'field': 'pl_masse', 'op': 'is_null'}
+#   {'field': 'pl_name', 'op': 'contains', 'value': 'kepler'}
+# and leaves are combined with {'and': [...]}, {'or': [...]} and {'not': {...}}.
+LEAF_OPERATORS = ['eq', 'in', 'range', 'is_null', 'not_null', 'contains']
+
+# Roughly how many index members can be read for the cost of fetching one planet record.
+# An index step is skipped, and its predicate checked on the fetched records instead, once
+# the candidates are few enough that reading the index would cost more than that.
+INDEX_MEMBERS_PER_RECORD = 50
+
+def parse_filter(expression):
+    """
+    Validate a filter expression and convert it into a tree of nodes, each with an 'op' key.
+
+    A plain dictionary of keys and values, the original advanced-filter body, is read as
+    the AND of an equality check on every key.
+
+    Args:
+        expression (dict): The filter expression from the request body.
+
+    Returns:
+        dict: The root node of the expression tree.
+
+    Raises:
+        ValueError: If the expression is malformed.
+    """
+    if not isinstance(expression, dict) or not expression:
+        raise ValueError('A filter must be a non-empty dictionary')
+
+    if 'and' in expression or 'or' in expression:
+        op = 'and' if 'and' in expression else 'or'
+        args = expression[op]
+        if not isinstance(args, list) or not args:
+            raise ValueError(f"'{op}' must be a non-empty list of filters")
+        return {'op': op, 'args': [parse_filter(arg) for arg in args]}
+
+    if 'not' in expression:
+        return {'op': 'not', 'arg': parse_filter(expression['not'])}
+
+    if 'field' in expression:
+        return _parse_leaf(expression)
+
+    # Original format: every key must equal its value
+    leaves = [{'field': key, 'op': 'eq', 'value': value} for key, value in expression.items()]
+    if len(leaves) == 1:
+        return leaves[0]
+    return {'op': 'and', 'args': leaves}
+
+def _parse_leaf(expression: dict):
+    """Validate a single predicate on one field."""
+    op = expression.get('op', 'eq')
+    leaf = {'field': expression['field'], 'op': op}
+
+    if not isinstance(leaf['field'], str):
+        raise ValueError("'field' must be a string")
+    if op not in LEAF_OPERATORS:
+        raise ValueError(f"Unknown operator '{op}', options are {LEAF_OPERATORS}")
+    if op in ('eq', 'contains'):
+        if 'value' not in expression:
+            raise ValueError(f"'{op}' requires a 'value'")
+        if not _is_scalar(expression['value']):
+            raise ValueError(f"'{op}' value must be a string, number, boolean or null")
+        leaf['value'] = expression['value']
+    elif op == 'in':
+        if not isinstance(expression.get('values'), list) or not expression['values']:
+            raise ValueError("'in' requires a non-empty list of 'values'")
+        if not all(_is_scalar(value) for value in expression['values']):
+            raise ValueError("'in' values must be strings, numbers, booleans or null")
+        leaf['values'] = expression['values']
+    elif op == 'range':
+        if 'min' not in expression and 'max' not in expression:
+            raise ValueError("'range' requires a 'min', a 'max' or both")
+        for bound in ('min', 'max'):
+            if bound in expression:
+                leaf[bound] = _to_number(expression[bound])
+                if leaf[bound] is None:
+                    raise ValueError(f"'range' {bound} must be a finite number")
+
+    return leaf
+
+def _is_scalar(value) -> bool:
+    """Return True if `value` can be compared with a record value, rather than being a list or dictionary."""
+    return value is None or isinstance(value, (str, int, float, bool))
+
+def _to_number(value):
+    """Return `value` as a float, or None if it is not a finite number."""
+    if isinstance(value, bool):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+def _equal(record_value, value) -> bool:
+    """Compare a record value with a filter value, numerically when both are numbers."""
+    if str(record_value) == str(value):
+        return True
+    record_number = _to_number(record_value)
+    number = _to_number(value)
+    return record_number is not None and record_number == number
+
+def matches(node: dict, record: dict) -> bool:
+    """Return True if the planet record satisfies the expression rooted at `node`."""
+    op = node['op']
+    if op == 'and':
+        return all(matches(arg, record) for arg in node['args'])
+    if op == 'or':
+        return any(matches(arg, record) for arg in node['args'])
+    if op == 'not':
+        return not matches(node['arg'], record)
+
+    value = record.get(node['field'])
+    if op == 'eq':
+        return _equal(value, node['value'])
+    if op == 'in':
+        return any(_equal(value, option) for option in node['values'])
+    if op == 'range':
+        number = _to_number(value)
+        if number is None:
+            return False
+        return node.get('min', number) <= number <= node.get('max', number)
+    if op == 'is_null':
+        return value is None or value == ''
+    if op == 'not_null':
+        return value is not None and value != ''
+    if op == 'contains':
+        return value is not None and str(node['value']).lower() in str(value).lower()
+
+def _indexable(node: dict) -> bool:
+    """Return True if the candidates for a node can be read entirely from the indexes."""
+    op = node['op']
+    if op == 'and' or op == 'or':
+        return all(_indexable(arg) for arg in node['args'])
+    if op == 'not':
+        return False
+
+    values = [node['value']] if op == 'eq' else node.get('values')
+    if node['field'] in CATEGORY_INDEX_FIELDS and op in ('eq', 'in'):
+        return all(value is not None and value != '' for value in values)
+    if node['field'] in RANGE_INDEX_FIELDS:
+        if op == 'range':
+            return True
+        if op in ('eq', 'in'):
+            return all(_to_number(value) is not None for value in values)
+    return False
+
+def _estimate(node: dict, client, generation: str) -> int:
+    """
+    Estimate how many planets an indexable node matches from the index sizes.
+    The estimate is stored on the node for the explain output.
+    """
+    op = node['op']
+    if op == 'and':
+        estimate = min(_estimate(arg, client, generation) for arg in node['args'])
+    elif op == 'or':
+        estimate = sum(_estimate(arg, client, generation) for arg in node['args'])
+    elif op == 'range':
+        estimate = client.zcount(range_index_key(node['field'], generation), node.get('min', '-inf'), node.get('max', '+inf'))
+    else:
+        values = [node['value']] if op == 'eq' else node['values']
+        if node['field'] in CATEGORY_INDEX_FIELDS:
+            estimate = sum(client.scard(category_index_key(node['field'], value, generation)) for value in values)
+        else:
+            key = range_index_key(node['field'], generation)
+            estimate = sum(client.zcount(key, _to_number(value), _to_number(value)) for value in values)
+    node['estimate'] = estimate
+    return estimate
+
+def _candidates(node: dict, client, generation: str) -> set:
+    """Return the names of the planets matching an indexable node, read from the indexes."""
+    op = node['op']
+    if op == 'and':
+        candidates = None
+        for arg in sorted(node['args'], key=lambda arg: arg['estimate']):
+            members = _candidates(arg, client, generation)
+            candidates = members if candidates is None else candidates & members
+            if not candidates:
+                break
+        return candidates
+    if op == 'or':
+        return set().union(*(_candidates(arg, client, generation) for arg in node['args']))
+    if op == 'range':
+        return set(client.zrangebyscore(range_index_key(node['field'], generation), node.get('min', '-inf'), node.get('max', '+inf')))
+
+    values = [node['value']] if op == 'eq' else node['values']
+    if node['field'] in CATEGORY_INDEX_FIELDS:
+        return client.sunion([category_index_key(node['field'], value, generation) for value in values])
+    key = range_index_key(node['field'], generation)
+    return set().union(*(client.zrangebyscore(key, _to_number(value), _to_number(value)) for value in values))
+
+def _combine(op: str, nodes: list):
+    """Join nodes with 'and' or 'or', returning None for no nodes."""
+    if not nodes:
+        return None
+    if len(nodes) == 1:
+        return nodes[0]
+    return {'op': op, 'args': nodes}
+
+def plan_filter(expression):
+    """
+    Compile a filter expression into a query plan and evaluate its indexed part.
+
+    The top level of the expression is split into AND-ed terms. Terms that can be answered
+    from the indexes are estimated and applied in order of increasing size, intersecting the
+    candidate planet names as they go. The remaining terms, and any indexed terms that would
+    cost more to read than checking them on the remaining candidates, form the residual
+    predicate applied to the fetched records. When no ingest has built the indexes the
+    whole expression is the residual predicate of a full scan.
+
+    Args:
+        expression (dict): The filter expression from the request body.
+
+    Returns:
+        dict: The plan, with the parsed expression, the candidate names (None for a full
+              scan), the residual predicate and the steps and timings for the explain output.
+
+    Raises:
+        ValueError: If the expression is malformed.
+    """
+    started = time.perf_counter()
+    root = parse_filter(expression)
+    terms = root['args'] if root['op'] == 'and' else [root]
+    plan = read_index(lambda client: _plan_terms(terms, client, started))
+    plan['expression'] = root
+    return plan
+
+def _plan_terms(terms: list, client, started: float) -> dict:
+    """Build the plan for the AND-ed terms of an expression, reading the indexes with `client`."""
+    generation = index_generation(client)
+    size = catalog_size(client)
+    if generation is None or size == 0:
+        indexed = []
+        residual = list(terms)
+    else:
+        indexed = [term for term in terms if _indexable(term)]
+        residual = [term for term in terms if not _indexable(term)]
+    for term in indexed:
+        _estimate(term, client, generation)
+    indexed.sort(key=lambda term: term['estimate'])
+    planned = time.perf_counter()
+
+    steps = []
+    candidates = None
+    for term in indexed:
+        if candidates is not None and not candidates:
+            steps.append({'predicate': term, 'strategy': 'skipped'})
+            continue
+        if candidates is not None and term['estimate'] > len(candidates) * INDEX_MEMBERS_PER_RECORD:
+            residual.append(term)
+            steps.append({'predicate': term, 'strategy': 'residual'})
+            continue
+        members = _candidates(term, client, generation)
+        candidates = members if candidates is None else candidates & members
+        steps.append({'predicate': term, 'strategy': 'index', 'candidates': len(candidates)})
+    indexed_at = time.perf_counter()
+
+    return {'candidates': candidates,
+            'residual': _combine('and', residual),
+            'steps': steps,
+            'catalog_size': size,
+            'timings_ms': {'plan': round((planned - started) * 1000, 3),
+                           'index': round((indexed_at - planned) * 1000, 3)}}
+
+def execute_plan(plan: dict):
+    """
+    Yield the planet records selected by a plan. Only the candidate planets are fetched
+    when the plan has them, otherwise the whole catalog is scanned.
+
+    Every record is checked against the whole expression, not just the residual predicate,
+    because an ingest rewrites the records before it switches to their new indexes, so a
+    candidate may no longer match the indexed predicates that selected it.
+    """
+    if plan['candidates'] is None:
+        records = iter_planets()
+    else:
+        records = fetch_planets(sorted(plan['candidates']))
+
+    expression = plan['expression']
+    for record in records:
+        if matches(expression, record):
+            yield record
+
+def explain_plan(plan: dict, results: list, fetch_ms: float) -> dict:
+    """Describe a plan and how long each phase took, for the explain option."""
+    candidates = plan['candidates']
+    return {'scan': 'full' if candidates is None else 'candidates',
+            'catalog_size': plan['catalog_size'],
+            'candidates': plan['catalog_size'] if candidates is None else len(candidates),
+            'index_steps': plan['steps'],
+            'residual': plan['residual'],
+            'matched': len(results),
+            'timings_ms': dict(plan['timings_ms'], fetch_and_filter=round(fetch_ms, 3))}
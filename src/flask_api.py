@@ -1,12 +1,14 @@
 import redis
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
 import json
 import logging
-import requests
 import os
 import csv
-import urllib.parse
-from jobs import add_job, get_job_by_id, rd, jdb, res
+import io
+import itertools
+import time
+from jobs import add_job, add_ingest_job, get_job_by_id, estimate_job_cost, job_lane, admission_check, iter_planets, iter_planet_names, get_planet, delete_planets, cone_search, neighbor_search, planet_position, jdb, res
+from filters import plan_filter, execute_plan, explain_plan
 
 app = Flask(__name__)
 
@@ -30,6 +32,61 @@ def convert_redis_data(redis_data):
         converted_data[key.decode()] = value.decode()
     return converted_data
 
+# Response formats that are streamed row by row instead of built up in memory
+STREAM_FORMATS = ['ndjson', 'csv']
+
+# Largest search radii, in degrees for cone searches and parsecs for neighbor searches, so a
+# single query only reads a bounded number of index cells
+MAX_CONE_RADIUS = 10.0
+MAX_NEIGHBOR_RADIUS = 100.0
+
+def _stream_csv(records):
+    """
+    Generator yielding the given planet records as CSV text, one row at a time.
+    The header is taken from the columns of the first record.
+    """
+    buffer = io.StringIO()
+    writer = None
+    for record in records:
+        if writer is None:
+            writer = csv.DictWriter(buffer, fieldnames=list(record.keys()), extrasaction='ignore')
+            writer.writeheader()
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+def _stream_ndjson(records):
+    """Generator yielding the given planet records as newline delimited JSON."""
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+def planet_response(records, output_format=None):
+    """
+    Build the response for an iterable of planet records.
+
+    With no format the records are returned as a single JSON list. The 'ndjson' and 'csv'
+    formats stream the records as they are read from Redis, so the full result is never
+    held in memory and the first rows are sent immediately.
+
+    Args:
+        records (iterable): The planet records to return.
+        output_format (str): None, 'ndjson' or 'csv'.
+
+    Returns:
+        A flask response and status code.
+    """
+    if output_format is None:
+        return jsonify(list(records)), 200
+    if output_format == 'ndjson':
+        return Response(_stream_ndjson(records), mimetype='application/x-ndjson'), 200
+    if output_format == 'csv':
+        return Response(_stream_csv(records), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=planets.csv'}), 200
+
+    logging.error(f"Unsupported output format '{output_format}'. Valid formats are {STREAM_FORMATS}.\n")
+    return jsonify({'message': f'Invalid format, options are {STREAM_FORMATS}'}), 400
+
 # Define a dictionary mapping routes to their descriptions and additional details
 route_details = {
     "/data": {
@@ -37,10 +94,8 @@ route_details = {
         "methods": ["POST", "DELETE", "GET"],
         "usage": {
             "POST": {
-                "description": "Add data to the Redis database.",
-                "parameters": {
-                    "data": "The data to be added."
-                },
+                "description": "Queue a job that downloads the exoplanet data and adds it to the Redis database. Returns the job, whose progress is shown by the '/jobs/<job_id>' route. Returns 409 if an ingest is already in progress.",
+                "parameters": {},
                 "example": "/data (POST)"
             },
             "DELETE": {
@@ -50,8 +105,12 @@ route_details = {
             },
             "GET": {
                 "description": "Retrieve all data from the Redis database.",
-                "parameters": {},
-                "example": "/data (GET)"
+                "parameters": {
+                    "limit": "Optional maximum number of records to return.",
+                    "planet_name": "Optional planet name to return the record for.",
+                    "format": "Optional 'ndjson' or 'csv' to stream the records instead of returning one JSON list."
+                },
+                "example": "/data?format=ndjson"
             }
         }
     },
@@ -86,7 +145,8 @@ route_details = {
             "GET": {
                 "description": "Filter data based on criteria.",
                 "parameters": {
-                    "key=value": "The key in the data to filter by and a value to search for"
+                    "key=value": "The key in the data to filter by and a value to search for",
+                    "format": "Optional 'ndjson' or 'csv' to stream the results."
                 },
                 "example": "planets/filter?disc_facility=Xinglong%20Station"
             }
@@ -99,7 +159,8 @@ route_details = {
             "GET": {
                 "description": "Search and retrieve data for specific exoplanets.",
                 "parameters": {
-                    "name=planet_name": "The name of the planet to search for (case insensitive)"
+                    "name=planet_name": "The name of the planet to search for (case insensitive)",
+                    "format": "Optional 'ndjson' or 'csv' to stream the results."
                 },
                 "example": "planets/search?name=kepler-1066%20b"
             }
@@ -112,12 +173,47 @@ route_details = {
             "POST": {
                 "description": "Filter data based on multiple criteria.",
                 "parameters": {
-                    "{'filters': {'key1': 'value',...}": "A json dictionary containing the keys to filter by and the values to search for"
+                    "{'filters': {'key1': 'value',...}": "A json dictionary containing the keys to filter by and the values to search for",
+                    "{'filters': {'and'|'or': [...]}}": "A boolean filter expression. Predicates look like {'field': 'pl_rade', 'op': 'range', 'min': 1, 'max': 2} where 'op' is one of 'eq', 'in', 'range', 'is_null', 'not_null' or 'contains', and can be combined with 'and', 'or' and 'not'",
+                    "explain": "Optional, true to also return the query plan and its timings",
+                    "format": "Optional query parameter, 'ndjson' or 'csv' to stream the results."
                 },
                 "example": "planets/advanced-filter' -d '{'filters': {'discoverymethod': 'Transit'}}' -H 'Content-Type: application/json'"
             }
         }
     }, 
+    "/planets/cone": {
+        "description": "Retrieve the exoplanets within an angular radius of a position on the sky, nearest first.",
+        "methods": ["GET"],
+        "usage": {
+            "GET": {
+                "description": "Cone search using the sky index. Each planet has its 'separation_deg' from the centre.",
+                "parameters": {
+                    "ra": "Right ascension of the centre in degrees (0-360).",
+                    "dec": "Declination of the centre in degrees (-90-90).",
+                    "radius": f"Radius of the cone in degrees (at most {MAX_CONE_RADIUS}).",
+                    "format": "Optional 'ndjson' or 'csv' to stream the results."
+                },
+                "example": "/planets/cone?ra=291.4&dec=42.5&radius=0.5"
+            }
+        }
+    },
+    "/planets/neighbors": {
+        "description": "Retrieve the exoplanets within a distance in parsecs of a planet or a point in space, nearest first.",
+        "methods": ["GET"],
+        "usage": {
+            "GET": {
+                "description": "Neighbor search using the 3D index. Each planet has its 'separation_pc' from the centre.",
+                "parameters": {
+                    "planet": "The name of the planet to search around. The planet itself is left out of the results.",
+                    "ra, dec, dist": "The right ascension and declination in degrees and distance in parsecs to search around, instead of 'planet'.",
+                    "radius": f"Radius of the search in parsecs (at most {MAX_NEIGHBOR_RADIUS}).",
+                    "format": "Optional 'ndjson' or 'csv' to stream the results."
+                },
+                "example": "/planets/neighbors?planet=TRAPPIST-1%20b&radius=10"
+            }
+        }
+    },
     "/stars": {
         "description": "Retrieve a list of all stars associated with exoplanets.",
         "methods": ["GET"],
@@ -143,13 +239,15 @@ route_details = {
         }
     },
     "/jobs": {
-        "description": "Submit new jobs for data plotting or retrieve a list of all created jobs. 'organize_by' is optional and options are 'Mass', 'Radius', and 'Orbit_Period'. Otherwise organize by year.",
+        "description": "Submit new jobs for data plotting or retrieve a list of all created jobs. 'organize_by' is optional and options are 'Mass', 'Radius', and 'Orbit_Period'. Otherwise organize by year. Passing a 'y_axis' with the same options creates a 2D density plot of 'organize_by' against 'y_axis'.",
         "methods": ["POST", "GET"],
         "usage": {
             "POST": {
                 "description": "Submit a new job for data plotting.",
                 "parameters": {
-                    "data": "The json dictionary that determines the data to plot."
+                    "data": "The json dictionary that determines the data to plot. 2D density plots also accept 'log_scale' (true/false) and 'bins' (1-500).",
+                    "priority": "Optional 'batch' to queue a cheap job behind interactive ones. Expensive jobs always go to the batch lane.",
+                    "X-Client-Id": "Optional header naming the client, used to share the queue fairly between clients. Defaults to the client address."
                 },
                 "example": "/jobs' -d '{'start_date': 2000, 'end_date': 2009, 'organize_by': 'Orbit_Period'}' -H 'Content-Type: application/json'"
             },
@@ -161,7 +259,7 @@ route_details = {
         }
     },
     "/jobs/<job_id>": {
-        "description": "Retrieve details about a specific job based on its ID.",
+        "description": "Retrieve details about a specific job based on its ID, including its lane ('priority'), estimated 'cost' and the seconds it spent queued ('queue_wait').",
         "methods": ["GET"],
         "usage": {
             "GET": {
@@ -185,6 +283,19 @@ route_details = {
                 "example": "/results/54321"
             }
         }
+    },
+    "/results/<job_id>/grid": {
+        "description": "Retrieve the binned grid behind a completed 2D density plot job.",
+        "methods": ["GET"],
+        "usage": {
+            "GET": {
+                "description": "Retrieve the bin edges and counts for a specific job.",
+                "parameters": {
+                    "job_id": "The ID of the job."
+                },
+                "example": "/results/54321/grid"
+            }
+        }
     }
 }
 
@@ -203,49 +314,33 @@ def modify_database():
     """
     Depending on the type of request, make modifications to the redis database. 
 
-    A POST request gets the data from the api in json format and saves each 
+    A POST request queues an ingest job, which gets the data from the api in json format and saves each 
     item as a key-value pair in the database. The TIC ids for each planet will represent the key in the pair.
+    Its progress can be followed through the '/jobs/<job_id>' route, and only one ingest runs at a time.
 
     A DELETE request will delete all key-value pairs of the hgnc data in the redis database.
 
     A GET request will return all the data currently stored in the redis database.
 
-    The below url contains table data:
-    https://exoplanetarchive.ipac.caltech.edu/docs/API_PS_columns.html#addtldata
-
     returns:
-        message (str): A message response if the user performs a POST or DELETE request.
+        job_dict (dict): The ingest job created by a POST request.
+        message (str): A message response if the user performs a DELETE request.
     """
 
     if request.method == 'POST':
-        base_url = 'https://exoplanetarchive.ipac.caltech.edu/TAP/sync'
-        query = 'select * from ps'
-        encoded_query = urllib.parse.quote_plus(query)
-        url = f"{base_url}?query={encoded_query}&format=json"
-        response = requests.get(url)
-        print("URL Requested:", url)
-        if response.status_code != 200:
-            print("Failed to fetch data from the URL.\n")
-            return "Failed to fetch data", 502
-        
-        data = response.json()
-        #print("Stuff is happening!")
-        if isinstance(data, list):  # Expecting a list of dictionaries
-            for item in data:
-                planet_id = item.get('pl_name')  # Assuming 'pl_name' is the identifier; adjust if necessary
-                if planet_id:
-                    rd.set(planet_id, json.dumps(item))
-            return f"{len(data)} records saved in Redis.", 200
-        else:
-            return "Invalid JSON format: List of dictionaries expected", 400
+        # Downloading and saving the catalog takes minutes, so a worker does it as a job
+        client = request.headers.get('X-Client-Id', request.remote_addr or 'anonymous')
+        job_dict, running_job = add_ingest_job(client)
+        if job_dict is None:
+            logging.error("An ingest is already queued or running. Follow its progress with the '/jobs/<job_id>' route.\n")
+            return jsonify({'message': 'An ingest is already in progress', 'id': running_job}), 409
+
+        return job_dict
         
     
     elif request.method == 'DELETE':
-        keys_deleted = 0
-        for key in rd.keys('*'):
-            rd.delete(key)
-            keys_deleted += 1
-        
+        keys_deleted = delete_planets()
+
         return f"Deleted {keys_deleted} records from Redis.", 200
     
     elif request.method == 'GET':
@@ -255,24 +350,28 @@ def modify_database():
         Query Parameters:
             - limit (int, optional): Limit the number of records returned.
             - planet_name (str, optional): Filter records by planet name.
+            - format (str, optional): 'ndjson' or 'csv' to stream the records.
 
         Returns:
             list: A list of data records matching the query criteria.
         """
         limit = request.args.get('limit', default=None, type=int)
         planet_name = request.args.get('planet_name', default=None, type=str)
+        output_format = request.args.get('format', default=None, type=str)
 
-        all_data = [json.loads(rd.get(key)) for key in rd.keys('*')]
+        if limit is not None and limit < 0:
+            logging.error("The 'limit' parameter must not be negative.\n")
+            return jsonify({'message': "'limit' must be a non-negative integer"}), 400
+
+        filtered_data = iter_planets()
 
         if planet_name:
-            filtered_data = [record for record in all_data if record.get('pl_name') == planet_name]
-        else:
-            filtered_data = all_data
+            filtered_data = (record for record in filtered_data if record.get('pl_name') == planet_name)
 
         if limit:
-            filtered_data = filtered_data[:limit]
+            filtered_data = itertools.islice(filtered_data, limit)
 
-        return jsonify(filtered_data), 200
+        return planet_response(filtered_data, output_format)
     
 @app.route('/planets', methods = ['GET'])
 def return_all_planet_ids():
@@ -282,27 +381,19 @@ def return_all_planet_ids():
     returns:
         list[str]: a list of all explanet IDs in string format
     """
-    keys = rd.keys()
-
-    for i in range(len(keys)):
-        keys[i] = keys[i].decode('utf-8')
-
-    return keys
+    return list(iter_planet_names())
 
 # Endpoint to filter based on one of the keys of the datase, for example Discovery Facility -> Xinglong Station: curl -X GET "http://localhost:5000/planets/filter?disc_facility=Xinglong%20Station"
 @app.route('/planets/filter', methods=['GET'])
 def filter_planets():
-    query_parameters = request.args
+    query_parameters = request.args.to_dict()
+    output_format = query_parameters.pop('format', None)
 
-    # Retrieve all exoplanet data from Redis (assuming 'rd' is your Redis connection)
-    keys = rd.keys()
-    exoplanets = [json.loads(rd.get(key)) for key in keys]
+    # Walk the catalog in batches rather than loading every record up front
+    filtered_planets = (planet for planet in iter_planets()
+                        if all(str(planet.get(key)) == value for key, value in query_parameters.items()))
 
-    filtered_planets = exoplanets
-    for key, value in query_parameters.items():
-        filtered_planets = [planet for planet in filtered_planets if str(planet.get(key)) == value]
-
-    return jsonify(filtered_planets)
+    return planet_response(filtered_planets, output_format)
 
 # Endpoint to search exoplanets by name, for example name -> Kepler-1066 b: curl -X GET "127.0.0.1:5000/planets/search?name=Kepler-1066%20b"
 @app.route('/planets/search', methods=['GET'])
@@ -312,14 +403,10 @@ def search_planets():
         return jsonify({'message': 'Search term "name" is required'}), 400
 
     try:
-        # Retrieve all exoplanet data from Redis (assuming 'rd' is your Redis connection)
-        keys = rd.keys()
-        exoplanets = [json.loads(rd.get(key)) for key in keys]
-
         # Filter exoplanets by name (case-insensitive)
-        filtered_planets = [planet for planet in exoplanets if planet.get('pl_name', '').lower() == name.lower()]
+        filtered_planets = (planet for planet in iter_planets() if planet.get('pl_name', '').lower() == name.lower())
 
-        return jsonify(filtered_planets), 200
+        return planet_response(filtered_planets, request.args.get('format'))
     except Exception as e:
         logging.error(f"An error occurred while searching for exoplanets: {str(e)}")
         return jsonify({'message': 'Internal server error'}), 500
@@ -334,11 +421,9 @@ def list_unique_stars():
         json: A JSON object containing a list of unique 'hostname' values, or an error message.
     """
     try:
-        all_keys = rd.keys()  # Retrieve all keys from Redis
         hostnames = set()  # A set to store unique hostnames
-        
-        for key in all_keys:
-            star_data = json.loads(rd.get(key).decode('utf-8'))  # Decode and load data for each key
+
+        for star_data in iter_planets():  # Read every planet record from Redis in batches
             hostname = star_data.get('hostname')
             if hostname:
                 hostnames.add(hostname)  # Add the hostname to the set if it's not None
@@ -362,13 +447,11 @@ def get_star(star_id: str):
         json: A list of exoplanet keys that have data with the specified 'hostname', or an error message.
     """
     try:
-        all_keys = rd.keys()  # Retrieve all keys from Redis
         matching_keys = []  # List to store keys that match the 'hostname'
-        
-        for key in all_keys:
-            star_data = json.loads(rd.get(key).decode('utf-8'))  # Decode and load data for each key
+
+        for star_data in iter_planets():  # Read every planet record from Redis in batches
             if star_data.get('hostname') == star_id:  # Check if the 'hostname' matches the star_id
-                matching_keys.append(key.decode('utf-8'))  # Add the key to the list if it matches
+                matching_keys.append(star_data['pl_name'])  # Add the key to the list if it matches
 
         if matching_keys:
             return jsonify({('Exoplanets orbiting ' + star_id): matching_keys}), 200  # Return the list of matching keys
@@ -391,31 +474,121 @@ def get_star(star_id: str):
 #        }
 #      }' \
 #  http://127.0.0.1:5000/planets/advanced-filter
+#
+# Filters can also be boolean expressions, for example transiting planets between 1 and 2 Earth radii
+# that are not around TOI-332, returning the query plan:
+#  -d '{
+#        "filters": {"and": [
+#          {"field": "discoverymethod", "op": "eq", "value": "Transit"},
+#          {"field": "pl_rade", "op": "range", "min": 1, "max": 2},
+#          {"not": {"field": "hostname", "op": "eq", "value": "TOI-332"}}
+#        ]},
+#        "explain": true
+#      }'
 
 @app.route('/planets/advanced-filter', methods=['POST'])
 def advanced_filter_planets():
+    """
+    Return the planets matching a filter expression.
+
+    The expression is compiled into a plan that reads the candidates from the secondary indexes,
+    smallest index first, and only fetches those planets to check the remaining predicates.
+    With 'explain' set, the chosen plan and its timings are returned alongside the results.
+
+    Returns:
+        json: A list of matching planets, or a dictionary with the 'plan' and 'results' when explaining.
+    """
     try:
         filters = request.get_json()
         if not filters or 'filters' not in filters:
             return jsonify({'message': 'Invalid request body'}), 400
-        
-        filters = filters['filters']
-        
-        # Retrieve exoplanets data from Redis or another source
-        keys = rd.keys()
-        exoplanets = [json.loads(rd.get(key)) for key in keys]
 
-        # Apply filters to the exoplanets data
-        filtered_planets = exoplanets
-        for key, value in filters.items():
-            filtered_planets = [planet for planet in filtered_planets if str(planet.get(key)) == str(value)]
+        try:
+            plan = plan_filter(filters['filters'])
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error(f"Invalid filter expression: {str(e)}")
+            return jsonify({'message': f'Invalid filter expression: {str(e)}'}), 400
+
+        if filters.get('explain'):
+            started = time.perf_counter()
+            results = list(execute_plan(plan))
+            fetch_ms = (time.perf_counter() - started) * 1000
+            return jsonify({'plan': explain_plan(plan, results, fetch_ms), 'results': results}), 200
 
-        return jsonify(filtered_planets), 200
+        return planet_response(execute_plan(plan), request.args.get('format'))
 
     except Exception as e:
         logging.error(f"An error occurred: {str(e)}")
         return jsonify({'message': 'Internal server error'}), 500
 
+# Endpoint to find the planets near a position on the sky, for example within half a degree of the Kepler field's centre:
+# curl -X GET "127.0.0.1:5000/planets/cone?ra=291.4&dec=42.5&radius=0.5"
+@app.route('/planets/cone', methods=['GET'])
+def cone_search_planets():
+    """
+    Return the planets within 'radius' degrees of the sky position ('ra', 'dec'), nearest first.
+    Only the sky cells overlapping the cone are read, so the cost depends on the cone rather than the catalog.
+
+    Returns:
+        json: A list of planets with their 'separation_deg', or an error message.
+    """
+    ra = request.args.get('ra', type=float)
+    dec = request.args.get('dec', type=float)
+    radius = request.args.get('radius', type=float)
+
+    if ra is None or dec is None or radius is None:
+        return jsonify({'message': "Parameters 'ra', 'dec' and 'radius' are required and must be numbers"}), 400
+    if not (0 <= ra <= 360) or not (-90 <= dec <= 90):
+        return jsonify({'message': "'ra' must be between 0 and 360 and 'dec' between -90 and 90"}), 400
+    if not (0 < radius <= MAX_CONE_RADIUS):
+        return jsonify({'message': f"'radius' must be greater than 0 and at most {MAX_CONE_RADIUS} degrees"}), 400
+
+    try:
+        return planet_response(cone_search(ra, dec, radius), request.args.get('format'))
+    except Exception as e:
+        logging.error(f"An error occurred during a cone search: {str(e)}")
+        return jsonify({'message': 'Internal server error'}), 500
+
+# Endpoint to find the planets near a planet or point in space, for example within 10 parsecs of TRAPPIST-1 b:
+# curl -X GET "127.0.0.1:5000/planets/neighbors?planet=TRAPPIST-1%20b&radius=10"
+@app.route('/planets/neighbors', methods=['GET'])
+def neighbor_search_planets():
+    """
+    Return the planets within 'radius' parsecs of a planet, or of the point ('ra', 'dec', 'dist'), nearest first.
+    Only the cubes of space overlapping the search sphere are read.
+
+    Returns:
+        json: A list of planets with their 'separation_pc', or an error message.
+    """
+    radius = request.args.get('radius', type=float)
+    if radius is None or not (0 < radius <= MAX_NEIGHBOR_RADIUS):
+        return jsonify({'message': f"'radius' is required and must be greater than 0 and at most {MAX_NEIGHBOR_RADIUS} parsecs"}), 400
+
+    name = request.args.get('planet')
+    if name:
+        planet = get_planet(name)
+        if planet is None:
+            logging.error("ID not found. Use the '/planets' route for a list of valid exoplanets stored in the database.\n")
+            return jsonify({'message': 'Planet not found'}), 404
+        ra, dec, dist = planet_position(planet)
+        if None in (ra, dec, dist):
+            return jsonify({'message': 'Planet has no known position and distance'}), 400
+    else:
+        ra = request.args.get('ra', type=float)
+        dec = request.args.get('dec', type=float)
+        dist = request.args.get('dist', type=float)
+        if ra is None or dec is None or dist is None:
+            return jsonify({'message': "Either 'planet' or numeric 'ra', 'dec' and 'dist' parameters are required"}), 400
+        if not (0 <= ra <= 360) or not (-90 <= dec <= 90) or dist < 0:
+            return jsonify({'message': "'ra' must be between 0 and 360, 'dec' between -90 and 90 and 'dist' not negative"}), 400
+
+    try:
+        neighbors = (planet for planet in neighbor_search(ra, dec, dist, radius) if planet.get('pl_name') != name)
+        return planet_response(neighbors, request.args.get('format'))
+    except Exception as e:
+        logging.error(f"An error occurred during a neighbor search: {str(e)}")
+        return jsonify({'message': 'Internal server error'}), 500
+
 
 #Currently spaces must be interpreted as %20 ie K2-374%20c
 @app.route('/planets/<planet_id>', methods = ['GET'])
@@ -429,26 +602,30 @@ def return_planet_data(planet_id: str):
     returns:
         (dict): A dictionary containing the data associated with the given id.
     """
-    all_keys = rd.keys()
-
-    for i in range(len(all_keys)):
-        all_keys[i] = all_keys[i].decode('utf-8')
-
-    for item in all_keys:
-        if item == planet_id:
-            return json.loads(rd.get(item))
+    planet = get_planet(planet_id)
+    if planet is not None:
+        return planet
 
     logging.error("ID not found. Use the '/planets' route for a list of valid exoplanets stored in the database.\n")
     return {}
 
 
+def queue_full_response(retry_after: int, status: dict):
+    """Build the 429 response refusing a job, asking the client to retry after `retry_after` seconds."""
+    logging.warning(f"Rejecting job: {status['queue_depth']} jobs queued, estimated wait {status['estimated_wait']:.0f}s.\n")
+    return jsonify({'message': 'Too many jobs queued, please retry later',
+                    'retry_after': retry_after, **status}), 429, {'Retry-After': str(retry_after)}
+
 @app.route('/jobs', methods = ['GET', 'POST'])
 def submit_jobs():
     """
     Depending on the type of request, create a new job or list the jobs that have been created.
 
     A POST request along with a dictionary containing a 'start_date', 'end_date', and an optional 'organize_by' key will create a new job.
+    An optional 'y_axis' key turns the job into a 2D density plot, which also accepts optional 'log_scale' and 'bins' keys.
     If the dictionary is not passed correctly, return a message. Worker scripts will then create histograms for the jobs.
+    Jobs are queued in the interactive or batch lane by their estimated cost, and a 429 response with a Retry-After
+    header is returned when the queue is too long.
 
     A GET request will list all the jobs that have been created
 
@@ -473,15 +650,52 @@ def submit_jobs():
             logging.error("Error creating job: an 'end_date' parameter must exist and it must be an integer.\n")
             return {}
 
+        # If the route is passed with only years, organize by years
+        organize_by = data.get('organize_by', 'None')
+        if organize_by != 'None' and organize_by not in valid_plot_options:
+            logging.error("Error creating job: Valid organizations are 'Radius', 'Mass', and 'Orbit_Period'\n")
+            return{}
+
+        y_axis = data.get('y_axis', 'None')
+        if y_axis != 'None' and y_axis not in valid_plot_options:
+            logging.error("Error creating job: Valid y axes are 'Radius', 'Mass', and 'Orbit_Period'\n")
+            return {}
+
         try:
-            if data['organize_by'] in valid_plot_options:
-                job_dict = add_job(data['start_date'], data['end_date'], data['organize_by'])
-            else:
-                logging.error("Error creating job: Valid organizations are 'Radius', 'Mass', and 'Orbit_Period'\n")
-                return{}
-        except KeyError:
-            # If the route is passed with only years, organize by years
-            job_dict = add_job(data['start_date'], data['end_date'])
+            bins = int(data.get('bins', 50))
+        except (TypeError, ValueError):
+            bins = 0
+        if bins < 1 or bins > 500:
+            logging.error("Error creating job: 'bins' must be an integer between 1 and 500.\n")
+            return {}
+
+        # Accept a JSON boolean or the common string forms, so "false" does not turn log scale on
+        log_scale = data.get('log_scale', False)
+        if isinstance(log_scale, str):
+            log_scale = {'true': True, '1': True, 'false': False, '0': False}.get(log_scale.strip().lower(), log_scale)
+        if not isinstance(log_scale, bool):
+            logging.error("Error creating job: 'log_scale' must be true or false.\n")
+            return {}
+
+        priority = data.get('priority')
+        if priority is not None and priority not in ['interactive', 'batch']:
+            logging.error("Error creating job: Valid priorities are 'interactive' and 'batch'\n")
+            return {}
+
+        # Refuse the job while its lane is backed up rather than letting the queue grow without bound
+        lane = job_lane(estimate_job_cost(limit, offset, organize_by, y_axis), priority)
+        retry_after, status = admission_check(lane)
+        if retry_after:
+            return queue_full_response(retry_after, status)
+
+        client = request.headers.get('X-Client-Id', request.remote_addr or 'anonymous')
+        job_dict = add_job(data['start_date'], data['end_date'], organize_by,
+                           y_axis=y_axis, log_scale=log_scale, bins=bins,
+                           client=client, priority=priority)
+        if job_dict is None:
+            # Other jobs filled the queue between the check above and this job being queued
+            retry_after, status = admission_check(lane)
+            return queue_full_response(max(retry_after, 1), status)
 
         return job_dict
 
@@ -536,12 +750,45 @@ def get_results(job_id:str):
         logging.warning("Job is still in progress. Please wait a moment.")
         return []
 
+    if job_data.get('job_type') == 'ingest':
+        logging.error("Ingest jobs do not create a plot.\n")
+        return []
+
     
     with open(path, 'wb') as f:
         f.write(res.hget(job_id, 'image'))
 
         return send_file(path, mimetype='image/png', as_attachment=True)
 
+@app.route('/results/<job_id>/grid', methods = ['GET'])
+def get_results_grid(job_id: str):
+    """
+    Return the binned grid behind a completed 2D density plot job. If the job does not exist, is still
+    in progress or is not a 2D density plot, return an empty dictionary.
+
+    Args:
+        job_id (str): The string associated with a job ID that exists
+
+    Returns:
+        (dict): The axis keys, bin edges and the count in each bin, indexed [x_bin][y_bin]
+    """
+    job_data = get_job_by_id(job_id)
+
+    if type(job_data) is str:
+        logging.error("Job not found. Use the '/jobs' route for a list of valid jobs created.\n")
+        return {}
+
+    if job_data['status'] != 'completed':
+        logging.warning("Job is still in progress. Please wait a moment.")
+        return {}
+
+    grid = res.hget(job_id, 'grid')
+    if grid is None:
+        logging.error("Job has no binned grid. Only 2D density plot jobs store one.\n")
+        return {}
+
+    return json.loads(grid)
+
 
 
 if __name__ == "__main__":
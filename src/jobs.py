@@ -2,51 +2,777 @@ import json
 import uuid
 import redis
 import os
-from hotqueue import HotQueue
+import time
+import random
+import logging
+import math
+import sky
+from redis.cluster import RedisCluster, ClusterNode
 
 _redis_ip = os.environ["REDIS_IP"]
 _redis_port = os.environ["REDIS_PORT"]
 
-rd = redis.Redis(host=_redis_ip, port=_redis_port, db=0)
-q = HotQueue("queue", host=_redis_ip, port=_redis_port, db=1)
+def _parse_endpoints(endpoints: str):
+    """
+    Parse a comma separated list of 'host:port' endpoints into (host, port) tuples.
+    The port defaults to 6379 when it is left out.
+    """
+    parsed = []
+    for endpoint in endpoints.split(','):
+        endpoint = endpoint.strip()
+        if not endpoint:
+            continue
+        host, _, port = endpoint.partition(':')
+        parsed.append((host, int(port or 6379)))
+    return parsed
+
+# The catalog (planet records and their indexes) can be served by read replicas of the
+# primary, listed in REDIS_REPLICAS, or by a Redis Cluster, listed in REDIS_CLUSTER_NODES.
+# The job queue, jobs and results always stay on the primary at REDIS_IP.
+_replica_endpoints = _parse_endpoints(os.environ.get('REDIS_REPLICAS', ''))
+_cluster_endpoints = _parse_endpoints(os.environ.get('REDIS_CLUSTER_NODES', ''))
+CATALOG_DATASET = os.environ.get('CATALOG_DATASET', 'ps')
+
+qdb = redis.Redis(host=_redis_ip, port=_redis_port, db=1)
 jdb = redis.Redis(host=_redis_ip, port=_redis_port, db=2)
 res = redis.Redis(host=_redis_ip, port=_redis_port, db=3)
 
+if _cluster_endpoints:
+    # A cluster only has database 0, so the planets and indexes share it under key prefixes.
+    # The hash tag puts every key of the dataset in the same slot, which keeps the index
+    # intersections and pipelines on a single node.
+    rd = RedisCluster(startup_nodes=[ClusterNode(host, port) for host, port in _cluster_endpoints],
+                      read_from_replicas=True)
+    idx = rd
+    PLANET_PREFIX = f'{{{CATALOG_DATASET}}}:planet:'
+    INDEX_PREFIX = f'{{{CATALOG_DATASET}}}:idx:'
+    _catalog_replicas = []
+    _index_replicas = []
+else:
+    rd = redis.Redis(host=_redis_ip, port=_redis_port, db=0)
+    idx = redis.Redis(host=_redis_ip, port=_redis_port, db=4)
+    PLANET_PREFIX = ''
+    INDEX_PREFIX = ''
+    # A replica that hangs times out and the read is retried on the primary
+    _catalog_replicas = [redis.Redis(host=host, port=port, db=0, socket_connect_timeout=1, socket_timeout=2)
+                         for host, port in _replica_endpoints]
+    _index_replicas = [redis.Redis(host=host, port=port, db=4, socket_connect_timeout=1, socket_timeout=2)
+                       for host, port in _replica_endpoints]
+
+# How long a replica that failed a health check is skipped, and how long a passed check is trusted
+_REPLICA_RETRY_SECONDS = 30
+_REPLICA_CHECK_SECONDS = 5
+_replica_health = {}
+
+def _endpoint(client) -> tuple:
+    """Return the (host, port, db) a client connects to, which keys the replica health cache."""
+    kwargs = client.connection_pool.connection_kwargs
+    return (kwargs.get('host'), kwargs.get('port'), kwargs.get('db'))
+
+def _replica_ready(replica) -> bool:
+    """
+    Return True if a replica is connected to the primary and has finished its initial sync.
+    A replica still syncing answers PING, but would serve an empty or stale catalog.
+    """
+    info = replica.info('replication')
+    return info.get('master_link_status') == 'up' and not info.get('master_sync_in_progress')
+
+def _mark_unhealthy(replica, reason: str):
+    """Skip a replica for the next `_REPLICA_RETRY_SECONDS`."""
+    logging.warning(f"Redis replica unavailable, reading from the primary instead: {reason}")
+    _replica_health[_endpoint(replica)] = (False, time.monotonic())
+
+def _pick_reader(primary, replicas: list):
+    """
+    Return a random healthy replica to read from, or the primary if none of them are ready.
+    Replicas are checked with INFO replication and the result is cached so most reads skip the check.
+    """
+    now = time.monotonic()
+    for replica in random.sample(replicas, len(replicas)):
+        endpoint = _endpoint(replica)
+        healthy, checked_at = _replica_health.get(endpoint, (True, None))
+        if checked_at is not None:
+            if healthy and now - checked_at < _REPLICA_CHECK_SECONDS:
+                return replica
+            if not healthy and now - checked_at < _REPLICA_RETRY_SECONDS:
+                continue
+        try:
+            ready = _replica_ready(replica)
+        except redis.RedisError as e:
+            _mark_unhealthy(replica, str(e))
+            continue
+        if not ready:
+            _mark_unhealthy(replica, 'replica is not in sync with the primary')
+            continue
+        _replica_health[endpoint] = (True, now)
+        return replica
+    return primary
+
+def _read(primary, replicas: list, operation):
+    """
+    Run `operation(client)` on a healthy replica, or the primary. A replica that drops the
+    connection or times out is marked unhealthy and the operation is retried once on the primary.
+    """
+    client = _pick_reader(primary, replicas)
+    try:
+        return operation(client)
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        if client is primary:
+            raise
+        _mark_unhealthy(client, str(e))
+        return operation(primary)
+
+def read_catalog(operation):
+    """Run `operation(client)` against the planet records, on a healthy replica or the primary."""
+    return _read(rd, _catalog_replicas, operation)
+
+def read_index(operation):
+    """Run `operation(client)` against the indexes, on a healthy replica or the primary."""
+    return _read(idx, _index_replicas, operation)
+
+def _scan_catalog(scan, done: set):
+    """
+    Yield from `scan(client, done)` on a healthy replica, or the primary. If the replica fails
+    part way through, the scan is repeated on the primary, skipping the keys in `done`, which
+    `scan` fills with the keys it has already yielded.
+    """
+    client = _pick_reader(rd, _catalog_replicas)
+    try:
+        yield from scan(client, done)
+    except (redis.ConnectionError, redis.TimeoutError) as e:
+        if client is rd:
+            raise
+        _mark_unhealthy(client, str(e))
+        yield from scan(rd, done)
+
+# Planet properties with secondary indexes in the `idx` database. Category fields are
+# indexed with one set of planet names per value, range fields with one sorted set
+# per field scored by the value.
+CATEGORY_INDEX_FIELDS = ['discoverymethod', 'disc_facility', 'disc_locale', 'hostname', 'pl_letter']
+RANGE_INDEX_FIELDS = ['disc_year', 'pl_masse', 'pl_rade', 'pl_orbper', 'sy_dist', 'sy_pnum', 'ra', 'dec']
+
+def planet_key(name) -> str:
+    """Return the key a planet's record is stored under."""
+    if isinstance(name, bytes):
+        name = name.decode('utf-8')
+    return PLANET_PREFIX + name
+
+def planet_name(key) -> str:
+    """Return the planet name for a record key."""
+    if isinstance(key, bytes):
+        key = key.decode('utf-8')
+    return key[len(PLANET_PREFIX):]
+
+def _catalog_key() -> str:
+    """Return the key of the hash holding the current index 'generation' and the catalog 'size'."""
+    return INDEX_PREFIX + '_catalog'
+
+def _generation_prefix(generation: str) -> str:
+    """Return the prefix of every index key in a generation."""
+    return f'{INDEX_PREFIX}{generation}:'
+
+def category_index_key(field: str, value, generation: str) -> str:
+    """Return the key of the set holding the names of planets whose `field` equals `value`."""
+    return f'{_generation_prefix(generation)}{field}:{value}'
+
+def range_index_key(field: str, generation: str) -> str:
+    """Return the key of the sorted set holding planet names scored by `field`."""
+    return _generation_prefix(generation) + field
+
+def sky_cell_key(cell: tuple, generation: str) -> str:
+    """Return the key of the set holding the names of planets in a sky cell."""
+    return f'{_generation_prefix(generation)}sky:{cell[0]}:{cell[1]}'
+
+def space_cell_key(cell: tuple, generation: str) -> str:
+    """Return the key of the set holding the names of planets in a cube of space."""
+    return f'{_generation_prefix(generation)}space:{cell[0]}:{cell[1]}:{cell[2]}'
+
+def index_generation(client=None):
+    """
+    Return the generation of the current indexes, or None if no ingest has built them, in which
+    case index-backed reads must scan the catalog instead.
+    """
+    if client is None:
+        return read_index(index_generation)
+    generation = client.hget(_catalog_key(), 'generation')
+    return generation.decode('utf-8') if generation is not None else None
+
+def catalog_size(client=None) -> int:
+    """Return the number of planets saved by the last ingest, or 0 if no ingest has built the indexes."""
+    if client is None:
+        return read_index(catalog_size)
+    size = client.hget(_catalog_key(), 'size')
+    return int(size) if size is not None else 0
+
+def index_planet(pipe, record: dict, generation: str):
+    """
+    Queue the index entries for a planet record on a pipeline of the `idx` database.
+    Missing values are left out of the indexes. Planets with a position are also added to
+    their sky cell, and to their cube of space when the distance is known.
+
+    Args:
+        pipe: A pipeline created from `idx`.
+        record (dict): The planet record.
+        generation (str): The index generation being built.
+    """
+    name = record['pl_name']
+    for field in CATEGORY_INDEX_FIELDS:
+        value = record.get(field)
+        if value is not None and value != '':
+            pipe.sadd(category_index_key(field, value, generation), name)
+    for field in RANGE_INDEX_FIELDS:
+        try:
+            pipe.zadd(range_index_key(field, generation), {name: float(record[field])})
+        except (KeyError, TypeError, ValueError):
+            continue
+
+    try:
+        ra, dec = float(record['ra']), float(record['dec'])
+    except (KeyError, TypeError, ValueError):
+        return
+    pipe.sadd(sky_cell_key(sky.sky_cell(ra, dec), generation), name)
+    try:
+        dist = float(record['sy_dist'])
+    except (KeyError, TypeError, ValueError):
+        return
+    pipe.sadd(space_cell_key(sky.space_cell(sky.cartesian(ra, dec, dist)), generation), name)
+
+def _delete_matching(client, match, batch_size: int = 500, keep=None) -> int:
+    """
+    Delete the keys matching a SCAN pattern in pipelined batches, returning how many were deleted.
+    Keys for which `keep` returns True are left in place.
+    """
+    deleted = 0
+    batch = []
+    for key in client.scan_iter(match=match, count=batch_size):
+        if keep is not None and keep(key):
+            continue
+        batch.append(key)
+        if len(batch) >= batch_size:
+            deleted += _delete_keys(client, batch)
+            batch = []
+    if batch:
+        deleted += _delete_keys(client, batch)
+    return deleted
+
+def _delete_keys(client, keys: list) -> int:
+    """Delete a batch of keys in a single pipeline round trip."""
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.delete(key)
+    return sum(pipe.execute())
+
+def clear_indexes():
+    """
+    Delete every index entry. The generation pointer is deleted first, so reads scan the catalog
+    rather than seeing partly deleted indexes.
+    """
+    idx.delete(_catalog_key())
+    if INDEX_PREFIX:
+        _delete_matching(idx, INDEX_PREFIX + '*')
+    else:
+        idx.flushdb()
+
+def delete_planets() -> int:
+    """Delete every planet record and index entry, returning the number of records deleted."""
+    clear_indexes()
+    return _delete_matching(rd, PLANET_PREFIX + '*')
+
+def save_planets(records: dict, batch_size: int = 500, progress=None):
+    """
+    Save planet records and their index entries, replacing the existing catalog.
+
+    The indexes are built under a new generation while reads keep using the current one, and
+    the generation pointer is then switched in a single command, so index-backed reads never
+    see a half-built index. Afterwards the planets that are not in `records` and the old
+    index generations are deleted.
+
+    Args:
+        records (dict): Planet records keyed by planet name.
+        batch_size (int): The number of records to write per pipeline round trip.
+        progress (callable): Optional function called with the number of records written after each batch.
+    """
+    generation = uuid.uuid4().hex
+    names = list(records)
+    for start in range(0, len(names), batch_size):
+        data_pipe = rd.pipeline(transaction=False)
+        index_pipe = idx.pipeline(transaction=False)
+        for name in names[start:start + batch_size]:
+            data_pipe.set(planet_key(name), json.dumps(records[name]))
+            index_planet(index_pipe, records[name], generation)
+        data_pipe.execute()
+        index_pipe.execute()
+        if progress is not None:
+            progress(min(start + batch_size, len(names)))
+
+    idx.hset(_catalog_key(), mapping={'generation': generation, 'size': len(names)})
+
+    # Planets dropped from the archive, then every index key outside the new generation
+    current = set(names)
+    _delete_matching(rd, PLANET_PREFIX + '*', keep=lambda key: planet_name(key) in current)
+    kept_prefix = _generation_prefix(generation).encode('utf-8')
+    catalog_key = _catalog_key().encode('utf-8')
+    _delete_matching(idx, INDEX_PREFIX + '*', keep=lambda key: key.startswith(kept_prefix) or key == catalog_key)
+
+def iter_planet_names(batch_size: int = 500):
+    """Yield the name of every planet in the catalog, walking the keys with SCAN."""
+    yield from _scan_catalog(lambda client, done: _scan_names(client, batch_size, done), set())
+
+def _scan_names(client, batch_size: int, done: set):
+    """Yield the names of the planets whose keys are not in `done`, adding each key as it is yielded."""
+    for key in client.scan_iter(match=PLANET_PREFIX + '*', count=batch_size):
+        if key not in done:
+            done.add(key)
+            yield planet_name(key)
+
+def get_planet(name: str):
+    """Return the record for a planet, or None if it is not in the catalog."""
+    value = read_catalog(lambda client: client.get(planet_key(name)))
+    if value is None:
+        return None
+    return json.loads(value)
+
+def iter_planets(batch_size: int = 500):
+    """
+    Yield every planet record in the catalog without loading the whole catalog at once.
+
+    Keys are walked with SCAN and the records are fetched in pipelined batches of
+    `batch_size`, so memory use stays proportional to the batch rather than the catalog.
+    Only the keys already read are remembered, so the scan can continue on the primary
+    if a replica fails part way through.
+
+    Args:
+        batch_size (int): The number of keys to fetch per pipeline round trip.
+
+    Yields:
+        dict: The decoded record for each planet.
+    """
+    yield from _scan_catalog(lambda client, done: _scan_planets(client, batch_size, done), set())
+
+def _scan_planets(client, batch_size: int, done: set):
+    """Yield the records of the planets whose keys are not in `done`, adding each batch's keys once it is fetched."""
+    batch = []
+    for key in client.scan_iter(match=PLANET_PREFIX + '*', count=batch_size):
+        if key in done:
+            continue
+        batch.append(key)
+        if len(batch) >= batch_size:
+            records = list(_fetch_planets(client, batch))
+            done.update(batch)
+            yield from records
+            batch = []
+    if batch:
+        records = list(_fetch_planets(client, batch))
+        done.update(batch)
+        yield from records
+
+def fetch_planets(names, batch_size: int = 500):
+    """
+    Yield the records of the given planets, fetched in pipelined batches of `batch_size`.
+    Names that are not in the catalog are skipped.
+    """
+    keys = [planet_key(name) for name in names]
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        yield from read_catalog(lambda client: list(_fetch_planets(client, batch)))
+
+def planet_position(record: dict):
+    """Return a planet's (ra, dec, sy_dist), with None for any value that is missing."""
+    position = []
+    for field in ('ra', 'dec', 'sy_dist'):
+        try:
+            position.append(float(record[field]))
+        except (KeyError, TypeError, ValueError):
+            position.append(None)
+    return tuple(position)
+
+def _cell_members(client, cells: list, cell_key):
+    """
+    Return the names of the planets in any of the given cells of the current index generation,
+    or None if no ingest has built the indexes.
+    """
+    generation = index_generation(client)
+    if generation is None or catalog_size(client) == 0:
+        return None
+    return client.sunion([cell_key(cell, generation) for cell in cells])
+
+def cone_search(ra: float, dec: float, radius: float) -> list:
+    """
+    Return the planets within `radius` degrees of a sky position, nearest first.
+
+    Only the sky cells that overlap the cone are read from the index, and only the planets
+    in those cells are fetched and checked against the exact angular separation. The whole
+    catalog is checked instead if no ingest has built the indexes.
+
+    Args:
+        ra (float): Right ascension of the cone's centre in degrees.
+        dec (float): Declination of the cone's centre in degrees.
+        radius (float): Radius of the cone in degrees.
+
+    Returns:
+        list: The planet records, each with its 'separation_deg' from the centre.
+    """
+    cells = sky.cone_cells(ra, dec, radius)
+    names = read_index(lambda client: _cell_members(client, cells, sky_cell_key))
+
+    results = []
+    records = iter_planets() if names is None else fetch_planets(sorted(names))
+    for record in records:
+        planet_ra, planet_dec, _ = planet_position(record)
+        if planet_ra is None or planet_dec is None:
+            continue
+        separation = sky.angular_separation(ra, dec, planet_ra, planet_dec)
+        if separation <= radius:
+            record['separation_deg'] = separation
+            results.append(record)
+    results.sort(key=lambda record: record['separation_deg'])
+    return results
+
+def neighbor_search(ra: float, dec: float, dist: float, radius: float) -> list:
+    """
+    Return the planets within `radius` parsecs of a point in space, nearest first.
+
+    Only the cubes of space that overlap the sphere are read from the index, and only the
+    planets in those cubes are fetched and checked against the exact distance. The whole
+    catalog is checked instead if no ingest has built the indexes.
+
+    Args:
+        ra (float): Right ascension of the centre in degrees.
+        dec (float): Declination of the centre in degrees.
+        dist (float): Distance of the centre from the Sun in parsecs.
+        radius (float): Radius of the sphere in parsecs.
+
+    Returns:
+        list: The planet records, each with its 'separation_pc' from the centre.
+    """
+    centre = sky.cartesian(ra, dec, dist)
+    cells = sky.sphere_cells(centre, radius)
+    names = read_index(lambda client: _cell_members(client, cells, space_cell_key))
+
+    results = []
+    records = iter_planets() if names is None else fetch_planets(sorted(names))
+    for record in records:
+        position = planet_position(record)
+        if None in position:
+            continue
+        separation = math.dist(centre, sky.cartesian(*position))
+        if separation <= radius:
+            record['separation_pc'] = separation
+            results.append(record)
+    results.sort(key=lambda record: record['separation_pc'])
+    return results
+
+def _fetch_planets(client, keys: list):
+    """Fetch the records for a batch of planet keys in a single pipeline round trip."""
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.get(key)
+    for value in pipe.execute():
+        # A key may have been deleted between SCAN and GET
+        if value is not None:
+            yield json.loads(value)
+
 def _generate_jid():
     """
     Generate a pseudo-random identifier for a job.
     """
     return str(uuid.uuid4())
 
-def _instantiate_job(jid: str, status: str, start_date: int, end_date: int, organize_by: str):
+def _instantiate_job(jid: str, status: str, start_date: int, end_date: int, organize_by: str,
+                     y_axis: str, log_scale: bool, bins: int):
     """
     Create the job object description as a python dictionary. Requires the job id,
-    status, limit and offset parameters.
+    status, limit and offset parameters. A `y_axis` other than 'None' makes the job a
+    2D density plot of `organize_by` against `y_axis`.
     """
     return {'id': jid,
             'status': status,
+            'job_type': 'plot',
             'start_date': start_date,
             'end_date': end_date,
-            'organize_by': organize_by}
+            'organize_by': organize_by,
+            'y_axis': y_axis,
+            'log_scale': log_scale,
+            'bins': bins}
 
 def _save_job(jid: str, job_dict: dict):
     """Save a job object in the Redis database."""
     jdb.set(jid, json.dumps(job_dict))
     return
 
-def _queue_job(jid: str):
-    """Add a job to the redis queue."""
-    q.put(jid)
-    return
+# Jobs wait in one of two lanes. Cheap jobs go to the interactive lane and expensive ones to
+# the batch lane, which workers serve once for every INTERACTIVE_TURNS jobs taken from the
+# interactive lane so it is never starved. Within a lane every client has its own list of
+# jobs and the clients are served round robin, so one client's burst cannot hold up the rest.
+LANES = ['interactive', 'batch']
+INTERACTIVE_TURNS = 3
+INTERACTIVE_MAX_COST = float(os.environ.get('INTERACTIVE_MAX_COST', 20))
+
+# Admission control. New jobs are refused once the queue holds MAX_QUEUE_DEPTH jobs or the
+# estimated wait in their lane exceeds MAX_QUEUE_WAIT seconds.
+MAX_QUEUE_DEPTH = int(os.environ.get('MAX_QUEUE_DEPTH', 500))
+MAX_QUEUE_WAIT = float(os.environ.get('MAX_QUEUE_WAIT', 300))
+QUEUE_WORKERS = int(os.environ.get('QUEUE_WORKERS', 1))
+
+# Relative cost per year of the date range for each kind of plot
+_AXIS_COST = {'year': 1.0, 'histogram': 1.5, 'density': 3.0}
+# Starting guess of worker seconds per unit of cost, replaced by measurements as jobs run
+_DEFAULT_SECONDS_PER_COST = 0.05
+
+# Every queue key shares the {queue} hash tag, so the scripts below only touch keys in one
+# slot and declare all of them in KEYS, as Redis requires of scripts.
+_QUEUE_SIGNAL = '{queue}:signal'
+_QUEUE_DEPTH = '{queue}:depth'
+_QUEUE_JOB_COST = '{queue}:job_cost'
+_QUEUE_TURN = '{queue}:turn'
+_SECONDS_PER_COST = '{queue}:seconds_per_cost'
+
+def _lane_clients_key(lane: str) -> str:
+    """Return the key of the list of clients with jobs waiting in a lane."""
+    return f'{{queue}}:lane:{lane}:clients'
+
+def _lane_jobs_key(lane: str) -> str:
+    """Return the key of the hash mapping each client to its space separated job ids waiting in a lane."""
+    return f'{{queue}}:lane:{lane}:jobs'
+
+def _lane_cost_key(lane: str) -> str:
+    """Return the key holding the total cost of the jobs waiting in a lane."""
+    return f'{{queue}}:lane:{lane}:cost'
+
+def _lane_keys(lane: str) -> list:
+    """Return the keys of a lane in the order the queue scripts expect them."""
+    return [_lane_clients_key(lane), _lane_jobs_key(lane), _lane_cost_key(lane)]
+
+# KEYS: lane's client list, lane's job hash, lane cost, job cost hash, depth counter, signal list
+# ARGV: client, job id, cost, maximum queue depth ('' for no limit)
+# Returns 1 if the job was queued, or 0 if the queue was already full.
+_enqueue_script = qdb.register_script("""
+if ARGV[4] ~= '' and tonumber(redis.call('GET', KEYS[5]) or 0) >= tonumber(ARGV[4]) then
+    return 0
+end
+local waiting = redis.call('HGET', KEYS[2], ARGV[1])
+if waiting then
+    redis.call('HSET', KEYS[2], ARGV[1], waiting .. ' ' .. ARGV[2])
+else
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+redis.call('INCR', KEYS[5])
+redis.call('INCRBYFLOAT', KEYS[3], ARGV[3])
+redis.call('HSET', KEYS[4], ARGV[2], ARGV[3])
+redis.call('RPUSH', KEYS[6], 1)
+return 1
+""")
+
+# KEYS: turn counter, depth counter, job cost hash, then the client list, job hash and cost
+#       of the interactive lane followed by those of the batch lane
+# ARGV: interactive turns per batch turn
+_dequeue_script = qdb.register_script("""
+local lanes = {3, 6}
+if redis.call('INCR', KEYS[1]) % (tonumber(ARGV[1]) + 1) == 0 then
+    lanes = {6, 3}
+end
+for _, offset in ipairs(lanes) do
+    local clients, jobs, cost = KEYS[offset + 1], KEYS[offset + 2], KEYS[offset + 3]
+    for i = 1, redis.call('LLEN', clients) do
+        local client = redis.call('LPOP', clients)
+        local waiting = redis.call('HGET', jobs, client)
+        if waiting then
+            local jid = waiting
+            local space = string.find(waiting, ' ', 1, true)
+            if space then
+                jid = string.sub(waiting, 1, space - 1)
+                redis.call('HSET', jobs, client, string.sub(waiting, space + 1))
+                redis.call('RPUSH', clients, client)
+            else
+                redis.call('HDEL', jobs, client)
+            end
+            local job_cost = redis.call('HGET', KEYS[3], jid) or 0
+            redis.call('HDEL', KEYS[3], jid)
+            redis.call('INCRBYFLOAT', cost, -tonumber(job_cost))
+            redis.call('DECR', KEYS[2])
+            return jid
+        end
+    end
+end
+return false
+""")
+
+def estimate_job_cost(start_date: int, end_date: int, organize_by="None", y_axis="None") -> float:
+    """
+    Estimate the relative cost of a plotting job from the width of its date range and the plot axes.
+    """
+    width = max(int(end_date) - int(start_date) + 1, 1)
+    if y_axis != 'None':
+        return width * _AXIS_COST['density']
+    if organize_by != 'None':
+        return width * _AXIS_COST['histogram']
+    return width * _AXIS_COST['year']
+
+def job_lane(cost: float, priority=None) -> str:
+    """Return the lane for a job: 'batch' if it is expensive or the client asked for it, else 'interactive'."""
+    if priority == 'batch' or cost > INTERACTIVE_MAX_COST:
+        return 'batch'
+    return 'interactive'
+
+def _seconds_per_cost() -> float:
+    """Return the measured worker seconds per unit of job cost."""
+    value = qdb.get(_SECONDS_PER_COST)
+    return float(value) if value is not None else _DEFAULT_SECONDS_PER_COST
+
+def queue_status(lane: str) -> dict:
+    """
+    Return the number of queued jobs and the estimated seconds a new job in `lane` would wait.
+    Interactive jobs only wait behind the interactive lane, batch jobs behind both lanes.
+    """
+    pipe = qdb.pipeline(transaction=False)
+    pipe.get(_QUEUE_DEPTH)
+    for name in LANES:
+        pipe.get(_lane_cost_key(name))
+    depth, *costs = pipe.execute()
+    costs = dict(zip(LANES, (float(cost or 0) for cost in costs)))
+
+    backlog = costs['interactive'] if lane == 'interactive' else sum(costs.values())
+    return {'queue_depth': int(depth or 0),
+            'estimated_wait': max(backlog, 0) * _seconds_per_cost() / max(QUEUE_WORKERS, 1)}
+
+def admission_check(lane: str):
+    """
+    Decide whether a new job may join `lane`.
 
-def add_job(start_date: int, end_date: int, organize_by="None", status="submitted"):
-    """Add a job to the redis queue."""
+    Returns:
+        (int, dict): The number of seconds the client should wait before retrying, 0 if the job
+                     is admitted, and the queue status the decision was based on.
+    """
+    status = queue_status(lane)
+    over_wait = status['estimated_wait'] - MAX_QUEUE_WAIT
+    over_depth = status['queue_depth'] - MAX_QUEUE_DEPTH + 1
+    if over_wait <= 0 and over_depth <= 0:
+        return 0, status
+
+    # Wait until the estimated wait is back under the limit and enough queued jobs have
+    # finished, taking each queued job to run for the average expected time
+    average_wait = status['estimated_wait'] / max(status['queue_depth'], 1)
+    return math.ceil(max(over_wait, over_depth * average_wait, 1)), status
+
+def _queue_job(jid: str, client: str, lane: str, cost: float, max_depth=None) -> bool:
+    """
+    Add a job to the end of its client's jobs in a lane of the redis queue. The depth check and
+    the push happen in one script, so concurrent submissions cannot grow the queue past `max_depth`.
+
+    Returns:
+        bool: True if the job was queued, False if the queue already held `max_depth` jobs.
+    """
+    queued = _enqueue_script(keys=_lane_keys(lane) + [_QUEUE_JOB_COST, _QUEUE_DEPTH, _QUEUE_SIGNAL],
+                             args=[client, jid, cost, '' if max_depth is None else max_depth])
+    return bool(queued)
+
+def dequeue_job(timeout: int = 5):
+    """
+    Wait up to `timeout` seconds for a job and take it off the queue, choosing the lane by
+    priority and the client round robin.
+
+    Returns:
+        str: The job id, or None if no job is waiting.
+    """
+    # Every queued job pushes one signal, so waiting on the signal list avoids polling the lanes.
+    # The lanes are still checked after a timeout in case a signal was lost.
+    qdb.blpop(_QUEUE_SIGNAL, timeout=timeout)
+    jid = _dequeue_script(keys=[_QUEUE_TURN, _QUEUE_DEPTH, _QUEUE_JOB_COST] + _lane_keys('interactive') + _lane_keys('batch'),
+                          args=[INTERACTIVE_TURNS])
+    if jid is None:
+        return None
+    return jid.decode('utf-8')
+
+def record_job_runtime(cost: float, seconds: float):
+    """Fold a finished job's run time into the measured seconds per unit of cost."""
+    if cost <= 0:
+        return
+    qdb.set(_SECONDS_PER_COST, 0.8 * _seconds_per_cost() + 0.2 * seconds / cost)
+
+def add_job(start_date: int, end_date: int, organize_by="None", status="submitted",
+            y_axis="None", log_scale=False, bins=50, client="anonymous", priority=None):
+    """Add a job to the redis queue, returning None if the queue already holds MAX_QUEUE_DEPTH jobs."""
     jid = _generate_jid()
-    job_dict = _instantiate_job(jid, status, start_date, end_date, organize_by)
+    job_dict = _instantiate_job(jid, status, start_date, end_date, organize_by, y_axis, log_scale, bins)
+    cost = estimate_job_cost(start_date, end_date, organize_by, y_axis)
+    job_dict.update({'client': client,
+                     'priority': job_lane(cost, priority),
+                     'cost': cost,
+                     'submitted_at': time.time()})
     _save_job(jid, job_dict)
-    _queue_job(jid)
+    if not _queue_job(jid, client, job_dict['priority'], cost, MAX_QUEUE_DEPTH):
+        jdb.delete(jid)
+        return None
     return job_dict
 
+# Only one catalog ingest may be queued or running at a time. The lock holds the ingest's job
+# id and expires on its own in case the worker running the ingest dies. A running ingest keeps
+# extending it, so a long ingest does not lose the lock.
+_INGEST_LOCK = 'ingest:lock'
+INGEST_LOCK_SECONDS = 3600
+
+# KEYS: lock. ARGV: job id. Deletes the lock only if the job still holds it.
+_release_lock_script = qdb.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+# KEYS: lock. ARGV: job id, seconds. Extends the lock if the job holds it, or takes it again if it
+# expired and no other ingest has taken it since. Returns 0 if another ingest holds the lock.
+_refresh_lock_script = qdb.register_script("""
+local holder = redis.call('GET', KEYS[1])
+if holder == ARGV[1] or not holder then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+return 0
+""")
+
+def add_ingest_job(client="anonymous"):
+    """
+    Queue a job that downloads the catalog and saves it in the Redis database.
+
+    Returns:
+        (dict, str): The new job dictionary and None, or None and the id of the ingest job
+                     already holding the lock.
+    """
+    jid = _generate_jid()
+    if not qdb.set(_INGEST_LOCK, jid, nx=True, ex=INGEST_LOCK_SECONDS):
+        running = qdb.get(_INGEST_LOCK)
+        return None, running.decode('utf-8') if running is not None else None
+
+    job_dict = {'id': jid,
+                'status': 'submitted',
+                'job_type': 'ingest',
+                'phase': 'queued',
+                'rows_fetched': 0,
+                'rows_written': 0,
+                'rows_per_sec': 0,
+                'client': client,
+                'priority': 'batch',
+                # Ingests are not compared against plotting jobs when estimating queue waits
+                'cost': 0,
+                'submitted_at': time.time()}
+    _save_job(jid, job_dict)
+    _queue_job(jid, client, 'batch', 0)
+    return job_dict, None
+
+def refresh_ingest_lock(jid: str) -> bool:
+    """
+    Extend the ingest lock held by the job `jid` for another INGEST_LOCK_SECONDS.
+
+    Returns:
+        bool: False if another ingest has taken the lock, in which case this one must stop.
+    """
+    return bool(_refresh_lock_script(keys=[_INGEST_LOCK], args=[jid, INGEST_LOCK_SECONDS]))
+
+def release_ingest_lock(jid: str):
+    """Release the ingest lock if it is held by the job `jid`."""
+    _release_lock_script(keys=[_INGEST_LOCK], args=[jid])
+
 def get_job_by_id(jid: str):
     """Return job dictionary given jid"""
     if jdb.get(jid) is None:
@@ -61,3 +787,22 @@ def update_job_status(jid: str, status: str):
         _save_job(jid, job_dict)
     else:
         raise Exception()
+
+def update_job_progress(jid: str, progress: dict):
+    """Merge the fields in `progress` into the job with job id `jid`."""
+    job_dict = get_job_by_id(jid)
+    if type(job_dict) is str:
+        raise Exception()
+    job_dict.update(progress)
+    _save_job(jid, job_dict)
+
+def start_job(jid: str):
+    """Mark a job taken off the queue as in progress and record how long it waited."""
+    job_dict = get_job_by_id(jid)
+    if type(job_dict) is str:
+        raise Exception()
+    job_dict['status'] = 'in_progress'
+    job_dict['started_at'] = time.time()
+    job_dict['queue_wait'] = round(job_dict['started_at'] - job_dict.get('submitted_at', job_dict['started_at']), 3)
+    _save_job(jid, job_dict)
+    return job_dict
@@ -0,0 +1,98 @@
+import math
+
+# The sky is divided into bands of declination SKY_CELL_DEG tall, and each band into cells
+# of right ascension about SKY_CELL_DEG wide at the band's edge nearest the equator, so the
+# cells cover roughly equal areas. Space is divided into cubes SPACE_CELL_PC parsecs wide,
+# centred on the Sun.
+SKY_CELL_DEG = 1.0
+SPACE_CELL_PC = 25.0
+_SKY_BANDS = int(round(180 / SKY_CELL_DEG))
+
+def _band(dec: float) -> int:
+    """Return the declination band holding `dec`."""
+    return min(max(int(math.floor((dec + 90) / SKY_CELL_DEG)), 0), _SKY_BANDS - 1)
+
+def _band_cells(band: int) -> int:
+    """Return the number of right ascension cells in a declination band."""
+    low = band * SKY_CELL_DEG - 90
+    high = low + SKY_CELL_DEG
+    widest = 0.0 if low <= 0 <= high else min(abs(low), abs(high))
+    return max(int(360 * math.cos(math.radians(widest)) / SKY_CELL_DEG), 1)
+
+def sky_cell(ra: float, dec: float) -> tuple:
+    """
+    Return the sky cell holding a position.
+
+    Args:
+        ra (float): Right ascension in degrees.
+        dec (float): Declination in degrees.
+
+    Returns:
+        (int, int): The declination band and right ascension cell.
+    """
+    band = _band(dec)
+    cells = _band_cells(band)
+    return band, int(math.floor((ra % 360) / 360 * cells)) % cells
+
+def cone_cells(ra: float, dec: float, radius: float) -> list:
+    """
+    Return every sky cell that may hold a position within `radius` degrees of (ra, dec).
+    Cells are never missed, but some of the cells returned may lie just outside the cone.
+    """
+    first_band = _band(dec - radius)
+    last_band = _band(dec + radius)
+
+    # Widest right ascension offset of any point in the cone, unless the cone covers a pole
+    if abs(dec) + radius >= 90:
+        half_width = 180.0
+    else:
+        ratio = math.sin(math.radians(radius)) / math.cos(math.radians(dec))
+        half_width = 180.0 if ratio >= 1 else math.degrees(math.asin(ratio))
+
+    cells = []
+    for band in range(first_band, last_band + 1):
+        count = _band_cells(band)
+        if half_width >= 180:
+            cells.extend((band, index) for index in range(count))
+            continue
+        first = int(math.floor((ra - half_width) / 360 * count))
+        last = int(math.floor((ra + half_width) / 360 * count))
+        indexes = {index % count for index in range(first, last + 1)}
+        cells.extend((band, index) for index in sorted(indexes))
+    return cells
+
+def angular_separation(ra1: float, dec1: float, ra2: float, dec2: float) -> float:
+    """Return the angle in degrees between two sky positions, using the haversine formula."""
+    ra1, dec1, ra2, dec2 = map(math.radians, (ra1, dec1, ra2, dec2))
+    a = math.sin((dec2 - dec1) / 2) ** 2 + math.cos(dec1) * math.cos(dec2) * math.sin((ra2 - ra1) / 2) ** 2
+    return math.degrees(2 * math.asin(min(math.sqrt(a), 1.0)))
+
+def cartesian(ra: float, dec: float, dist: float) -> tuple:
+    """Return the heliocentric (x, y, z) position in parsecs of an object at (ra, dec) and `dist` parsecs."""
+    ra, dec = math.radians(ra), math.radians(dec)
+    return (dist * math.cos(dec) * math.cos(ra),
+            dist * math.cos(dec) * math.sin(ra),
+            dist * math.sin(dec))
+
+def space_cell(position: tuple) -> tuple:
+    """Return the cube of space holding an (x, y, z) position."""
+    return tuple(int(math.floor(coordinate / SPACE_CELL_PC)) for coordinate in position)
+
+def sphere_cells(position: tuple, radius: float) -> list:
+    """Return every cube of space that overlaps the sphere of `radius` parsecs around `position`."""
+    ranges = [range(int(math.floor((coordinate - radius) / SPACE_CELL_PC)),
+                    int(math.floor((coordinate + radius) / SPACE_CELL_PC)) + 1)
+              for coordinate in position]
+
+    cells = []
+    for i in ranges[0]:
+        for j in ranges[1]:
+            for k in ranges[2]:
+                # Distance from the centre to the nearest point of the cube
+                gap = 0.0
+                for index, coordinate in zip((i, j, k), position):
+                    low = index * SPACE_CELL_PC
+                    gap += max(low - coordinate, 0.0, coordinate - low - SPACE_CELL_PC) ** 2
+                if gap <= radius ** 2:
+                    cells.append((i, j, k))
+    return cells
@@ -1,68 +1,295 @@
-from jobs import get_job_by_id, update_job_status, q, rd, res
+from jobs import (get_job_by_id, update_job_status, update_job_progress, start_job, dequeue_job, record_job_runtime,
+                  refresh_ingest_lock, release_ingest_lock, save_planets, iter_planets, res)
+import codecs
 import json
 import logging
+import time
+import requests
+import urllib.parse
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+import numpy as np
 
-@q.worker
-def process_job(job_id: str):
+# Maps the 'organize_by' and 'y_axis' job options to the record key and axis title
+PLOT_AXES = {
+    'None': ('disc_year', 'Year Discovered'),
+    'Mass': ('pl_masse', 'Mass of planet (Earth Masses)'),
+    'Radius': ('pl_rade', 'Radius of planet (Earth Radii)'),
+    'Orbit_Period': ('pl_orbper', 'Orbit Period (Earth Days)'),
+}
+
+def _save_plot(job_id: str):
+    """Save the current figure and store the resulting image in the Redis database."""
+    plt.savefig(f'{job_id}_plot.png')
+    plt.close()
+
+    with open(f'{job_id}_plot.png', 'rb') as image_file:
+        image_data = image_file.read()
+        res.hset(job_id, 'image', image_data)
+
+def _bin_edges(values, bins: int, log_scale: bool):
     """
-    Process a specific job by generating a histogram and storing the resulting image.
-    
-    Args:
-        job_id (str): The ID of the job to process.
+    Return `bins` + 1 bin edges spanning the given values, spaced logarithmically if `log_scale` is set.
     """
-    update_job_status(job_id, 'in_progress')
-    job_dict = get_job_by_id(job_id)
+    if values.size == 0:
+        low, high = 1.0, 10.0
+    else:
+        low, high = values.min(), values.max()
+    if low == high:
+        high = low * 10 if log_scale else low + 1
 
-    values_to_plot = []
-    all_keys = rd.keys()
+    if log_scale:
+        return np.logspace(np.log10(low), np.log10(high), bins + 1)
+    return np.linspace(low, high, bins + 1)
 
-    start_date = int(job_dict['start_date'])
-    end_date = int(job_dict['end_date'])
+def plot_histogram(job_id: str, job_dict: dict, start_date: int, end_date: int):
+    """
+    Create a histogram of one planet property for the planets discovered in the job's date range.
 
-    if job_dict['organize_by'] == 'None':
-        x_axis = 'disc_year'
-        x_title = 'Year Discovered'
-    elif job_dict['organize_by'] == 'Mass':
-        x_axis = 'pl_masse'
-        x_title = 'Mass of planet (Earth Masses)'
-    elif job_dict['organize_by'] == 'Radius':
-        x_axis = 'pl_rade'
-        x_title = 'Radius of planet (Earth Radii)'
-    elif job_dict['organize_by'] == 'Orbit_Period':
-        x_axis = 'pl_orbper'
-        x_title = 'Orbit Period (Earth Days)'
-    else:
-        update_job_status(job_id, 'failed')
-        logging.error(f"Unsupported plot organization for job {job_id}.")
-        return ''
+    Args:
+        job_id (str): The ID of the job to process.
+        job_dict (dict): The job description.
+        start_date (int): The first discovery year to include.
+        end_date (int): The last discovery year to include.
+    """
+    x_axis, x_title = PLOT_AXES[job_dict['organize_by']]
+    values_to_plot = []
 
-    for key in all_keys:
-        planet = json.loads(rd.get(key))
+    for planet in iter_planets():
         try:
             if ((int(planet['disc_year'])) >= start_date) and (int(planet['disc_year']) <= end_date):
                 values_to_plot.append(int(planet[x_axis]))
-        except TypeError:
+        except (TypeError, KeyError):
             continue
 
     num_bins = 20
     if x_axis == 'disc_year':
         num_bins = max((end_date - start_date), 1)
-    
+
     plt.hist(values_to_plot, num_bins)
     plt.xlabel(x_title)
     plt.ylabel('Number of Exoplanets')
     plt.title(f'Summary of Planets Discovered Between {start_date} and {end_date}')
-    plt.savefig(f'{job_id}_plot.png')
-    plt.close
+    _save_plot(job_id)
 
-    # Store resulting image in Redis database
-    with open(f'{job_id}_plot.png', 'rb') as image_file:
-        image_data = image_file.read()
-        res.hset(job_id, 'image', image_data)
+def plot_density(job_id: str, job_dict: dict, start_date: int, end_date: int):
+    """
+    Create a 2D density plot of two planet properties for the planets discovered in the job's date range.
+
+    The points are binned into a fixed grid with numpy.histogram2d and the grid is drawn instead of
+    the individual planets, so the render time and image size do not grow with the number of planets.
+    The binned grid is stored alongside the image under the 'grid' field of the job's result.
+
+    Args:
+        job_id (str): The ID of the job to process.
+        job_dict (dict): The job description.
+        start_date (int): The first discovery year to include.
+        end_date (int): The last discovery year to include.
+    """
+    x_axis, x_title = PLOT_AXES[job_dict['organize_by']]
+    y_axis, y_title = PLOT_AXES[job_dict['y_axis']]
+    log_scale = bool(job_dict.get('log_scale', False))
+    bins = int(job_dict.get('bins', 50))
+    x_values = []
+    y_values = []
+
+    for planet in iter_planets():
+        try:
+            if (int(planet['disc_year']) < start_date) or (int(planet['disc_year']) > end_date):
+                continue
+            x_value = float(planet[x_axis])
+            y_value = float(planet[y_axis])
+        except (TypeError, ValueError, KeyError):
+            continue
+        x_values.append(x_value)
+        y_values.append(y_value)
+
+    x_values = np.array(x_values)
+    y_values = np.array(y_values)
+    if log_scale:
+        # Planets with non-positive values cannot be placed on a log axis
+        keep = (x_values > 0) & (y_values > 0)
+        x_values = x_values[keep]
+        y_values = y_values[keep]
+
+    counts, x_edges, y_edges = np.histogram2d(x_values, y_values,
+                                              bins=[_bin_edges(x_values, bins, log_scale),
+                                                    _bin_edges(y_values, bins, log_scale)])
+
+    fig, ax = plt.subplots()
+    mesh = ax.pcolormesh(x_edges, y_edges, np.ma.masked_equal(counts.T, 0),
+                         norm=LogNorm(vmin=1, vmax=max(counts.max(), 10)))
+    if log_scale:
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+    fig.colorbar(mesh, ax=ax, label='Number of Exoplanets')
+    ax.set_xlabel(x_title)
+    ax.set_ylabel(y_title)
+    ax.set_title(f'Planets Discovered Between {start_date} and {end_date}')
+    _save_plot(job_id)
+
+    res.hset(job_id, 'grid', json.dumps({'x_axis': x_axis,
+                                         'y_axis': y_axis,
+                                         'x_edges': x_edges.tolist(),
+                                         'y_edges': y_edges.tolist(),
+                                         'counts': counts.astype(int).tolist()}))
+
+def _iter_json_array(chunks):
+    """
+    Yield the items of a JSON array as its bytes arrive in `chunks`, so the whole response never
+    has to be held in memory. Only the text of the item being received is buffered.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    started = False
+    for chunk in chunks:
+        buffer = buffer[position:] + text.decode(chunk)
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position >= len(buffer):
+                break
+            if not started:
+                if buffer[position] != '[':
+                    raise Exception("Invalid JSON format: List of dictionaries expected")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The rest of the item has not arrived yet
+                break
+            yield item
+    raise Exception("Invalid JSON format: the response ended before the list was closed")
+
+def _keep_ingest_lock(job_id: str):
+    """Extend the ingest lock, stopping the ingest if another ingest has taken it."""
+    if not refresh_ingest_lock(job_id):
+        raise Exception("The ingest lock was taken by another ingest")
+
+def run_ingest(job_id: str):
+    """
+    Download the planetary systems table from the NASA Exoplanet Archive and save each planet in the
+    redis database, keyed by its name. Progress is written to the job as it runs: the 'phase'
+    ('fetching', 'writing' then 'completed'), 'bytes_fetched', 'rows_fetched', 'rows_written' and 'rows_per_sec'.
+    The response is parsed as it downloads, so only the planet records are held in memory, and the
+    ingest lock is extended with every progress update.
+
+    The below url contains table data:
+    https://exoplanetarchive.ipac.caltech.edu/docs/API_PS_columns.html#addtldata
+
+    Args:
+        job_id (str): The ID of the ingest job.
+    """
+    try:
+        _keep_ingest_lock(job_id)
+        base_url = 'https://exoplanetarchive.ipac.caltech.edu/TAP/sync'
+        query = 'select * from ps'
+        encoded_query = urllib.parse.quote_plus(query)
+        url = f"{base_url}?query={encoded_query}&format=json"
+
+        update_job_progress(job_id, {'phase': 'fetching', 'bytes_fetched': 0, 'rows_fetched': 0})
+        response = requests.get(url, stream=True, timeout=60)
+        logging.info(f"URL Requested: {url}")
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch data from the URL, status {response.status_code}")
+
+        fetched = {'bytes_fetched': 0, 'rows_fetched': 0}
+        def chunks():
+            for chunk in response.iter_content(chunk_size=1 << 16):
+                fetched['bytes_fetched'] += len(chunk)
+                yield chunk
+
+        # Later rows for the same planet replace earlier ones, so index only the final record
+        records = {}
+        last_update = time.monotonic()
+        for item in _iter_json_array(chunks()):
+            if not isinstance(item, dict):  # Expecting a list of dictionaries
+                raise Exception("Invalid JSON format: List of dictionaries expected")
+            fetched['rows_fetched'] += 1
+            planet_id = item.get('pl_name')
+            if planet_id:
+                records[planet_id] = item
+            if time.monotonic() - last_update >= 1:
+                _keep_ingest_lock(job_id)
+                update_job_progress(job_id, dict(fetched))
+                last_update = time.monotonic()
+
+        update_job_progress(job_id, dict(fetched, phase='writing'))
+
+        started = time.monotonic()
+        def report(rows_written: int):
+            _keep_ingest_lock(job_id)
+            elapsed = max(time.monotonic() - started, 1e-6)
+            update_job_progress(job_id, {'rows_written': rows_written, 'rows_per_sec': round(rows_written / elapsed, 1)})
+        save_planets(records, progress=report)
+
+        update_job_progress(job_id, {'phase': 'completed', 'status': 'completed'})
+        logging.info(f"Ingest {job_id} saved {len(records)} records.")
+
+    except Exception as e:
+        update_job_progress(job_id, {'status': 'failed', 'error': str(e)})
+        logging.error(f"Ingest {job_id} failed: {str(e)}")
+
+    finally:
+        release_ingest_lock(job_id)
+
+def process_job(job_id: str):
+    """
+    Process a specific job by generating a histogram or 2D density plot and storing the resulting image,
+    or by ingesting the catalog for ingest jobs.
+
+    Args:
+        job_id (str): The ID of the job to process.
+    """
+    job_dict = start_job(job_id)
+
+    if job_dict.get('job_type') == 'ingest':
+        run_ingest(job_id)
+        return
+
+    start_date = int(job_dict['start_date'])
+    end_date = int(job_dict['end_date'])
+    y_axis = job_dict.get('y_axis', 'None')
+
+    if job_dict['organize_by'] not in PLOT_AXES or y_axis not in PLOT_AXES:
+        update_job_status(job_id, 'failed')
+        logging.error(f"Unsupported plot organization for job {job_id}.")
+        return ''
+
+    if y_axis == 'None':
+        plot_histogram(job_id, job_dict, start_date, end_date)
+    else:
+        plot_density(job_id, job_dict, start_date, end_date)
 
     update_job_status(job_id, 'completed')
     logging.info(f"Job {job_id} completed successfully.")
 
+def consume_jobs():
+    """
+    Take jobs off the queue one at a time, in the order chosen by the priority lanes, and process them.
+    The run time of each job is recorded so the API can estimate queue wait times.
+    """
+    while True:
+        job_id = dequeue_job()
+        if job_id is None:
+            continue
+
+        started = time.monotonic()
+        try:
+            process_job(job_id)
+        except Exception as e:
+            logging.error(f"Job {job_id} failed: {str(e)}")
+            if type(get_job_by_id(job_id)) is dict:
+                update_job_status(job_id, 'failed')
+            continue
+        record_job_runtime(float(get_job_by_id(job_id).get('cost', 0)), time.monotonic() - started)
+
 if __name__ == '__main__':
-    process_job()
+    consume_jobs()
@@ -6,12 +6,21 @@ import sys
 sys.path.append('../src')
 
 from flask_api import app
+import jobs
 
 @pytest.fixture
 def client():
     with app.test_client() as client:
         yield client
 
+@pytest.fixture
+def test_catalog(monkeypatch):
+    """Keep the planets and indexes a test saves under their own key prefixes, away from the real catalog."""
+    monkeypatch.setattr(jobs, 'PLANET_PREFIX', jobs.PLANET_PREFIX + 'test:planet:')
+    monkeypatch.setattr(jobs, 'INDEX_PREFIX', jobs.INDEX_PREFIX + 'test:idx:')
+    yield
+    jobs.delete_planets()
+
 def test_help_route(client):
     """Test the help route to ensure it returns the expected status code and data structure."""
     response = client.get('/help')
@@ -35,11 +44,127 @@ def test_get_data(client):
     response = client.get('/data')
     assert response.status_code == 200
 
+def test_get_data_streaming(client):
+    """Test the streaming formats of the /data route."""
+    response = client.get('/data?format=ndjson')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    for line in response.data.splitlines():
+        assert type(json.loads(line)) == dict
+
+    response = client.get('/data?format=csv')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+
+    response = client.get('/data?format=xml')
+    assert response.status_code == 400
+
+def test_get_data_negative_limit(client):
+    """Test that a negative limit is rejected rather than failing the request."""
+    response = client.get('/data?limit=-1')
+    assert response.status_code == 400
+
+def test_filter_planets_streaming(client):
+    """Test that the format parameter is not treated as a filter key."""
+    response = client.get('/planets/filter?discoverymethod=Transit&format=ndjson')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+
 def test_search_planets(client):
     """Test searching planets by name."""
     response = client.get('/planets/search?name=Kepler-10b')
     assert response.status_code == 200
 
+def test_advanced_filter_expression(client):
+    """Test a boolean filter expression with the explain option."""
+    filters = {"or": [
+        {"field": "discoverymethod", "op": "in", "values": ["Transit", "Imaging"]},
+        {"not": {"field": "pl_rade", "op": "range", "min": 1, "max": 2}}
+    ]}
+    response = client.post('/planets/advanced-filter', json={"filters": filters, "explain": True})
+    assert response.status_code == 200
+    assert "plan" in response.json
+    assert type(response.json["results"]) == list
+
+def test_advanced_filter_invalid_expression(client):
+    """Test that a malformed filter expression is rejected."""
+    response = client.post('/planets/advanced-filter', json={"filters": {"field": "pl_rade", "op": "between"}})
+    assert response.status_code == 400
+
+    for filters in [{"field": "pl_rade", "op": "range", "min": "nan"},
+                    {"field": ["pl_rade"], "op": "eq", "value": 1},
+                    {"field": "hostname", "op": "in", "values": [["TOI-332"]]}]:
+        response = client.post('/planets/advanced-filter', json={"filters": filters})
+        assert response.status_code == 400
+
+def test_advanced_filter_rechecks_candidates(client, test_catalog):
+    """Test that a record rewritten since it was indexed is checked again rather than returned."""
+    jobs.save_planets({'Rewritten b': {'pl_name': 'Rewritten b', 'hostname': 'A', 'pl_rade': 1.5}})
+    jobs.rd.set(jobs.planet_key('Rewritten b'), json.dumps({'pl_name': 'Rewritten b', 'hostname': 'B', 'pl_rade': 9}))
+
+    filters = {"and": [{"field": "hostname", "op": "eq", "value": "A"},
+                       {"field": "pl_rade", "op": "range", "min": 1, "max": 2}]}
+    response = client.post('/planets/advanced-filter', json={"filters": filters})
+    assert response.json == []
+
+def test_advanced_filter_uses_indexes(client, test_catalog):
+    """Test that indexed predicates are answered from the indexes, smallest estimate first."""
+    jobs.save_planets({f'Indexed {i}': {'pl_name': f'Indexed {i}',
+                                         'discoverymethod': 'Transit' if i % 2 else 'Imaging',
+                                         'hostname': 'Small' if i < 3 else 'Large',
+                                         'pl_rade': i}
+                       for i in range(10)})
+
+    filters = {"and": [{"field": "discoverymethod", "op": "eq", "value": "Transit"},
+                       {"field": "hostname", "op": "eq", "value": "Small"},
+                       {"field": "pl_rade", "op": "range", "max": 5}]}
+    response = client.post('/planets/advanced-filter', json={"filters": filters, "explain": True})
+    plan = response.json['plan']
+    assert plan['scan'] == 'candidates'
+    assert [step['predicate']['field'] for step in plan['index_steps']] == ['hostname', 'discoverymethod', 'pl_rade']
+    estimates = [step['predicate']['estimate'] for step in plan['index_steps']]
+    assert estimates == sorted(estimates)
+    assert [planet['pl_name'] for planet in response.json['results']] == ['Indexed 1']
+
+def test_advanced_filter_without_indexes(client, test_catalog):
+    """Test that a catalog saved without indexes is scanned instead of returning no matches."""
+    for name, method in [('Unindexed b', 'Transit'), ('Unindexed c', 'Imaging')]:
+        jobs.rd.set(jobs.planet_key(name), json.dumps({'pl_name': name, 'discoverymethod': method, 'hostname': 'Unindexed'}))
+
+    response = client.post('/planets/advanced-filter', json={"filters": {"hostname": "Unindexed", "discoverymethod": "Transit"}})
+    assert response.status_code == 200
+    assert [planet['pl_name'] for planet in response.json] == ['Unindexed b']
+
+def test_cone_search(client):
+    """Test that a cone search only returns planets inside the cone, nearest first."""
+    response = client.get('/planets/cone?ra=290&dec=40&radius=10')
+    assert response.status_code == 200
+    separations = [planet['separation_deg'] for planet in response.json]
+    assert all(separation <= 10 for separation in separations)
+    assert separations == sorted(separations)
+
+    assert client.get('/planets/cone?ra=290&dec=40').status_code == 400
+    assert client.get('/planets/cone?ra=290&dec=95&radius=1').status_code == 400
+    assert client.get('/planets/cone?ra=290&dec=40&radius=90').status_code == 400
+
+def test_neighbor_search(client):
+    """Test the 3D neighbor search around a point and the parameter checks."""
+    response = client.get('/planets/neighbors?ra=0&dec=0&dist=0&radius=50')
+    assert response.status_code == 200
+    assert all(planet['separation_pc'] <= 50 for planet in response.json)
+
+    assert client.get('/planets/neighbors?radius=50').status_code == 400
+    assert client.get('/planets/neighbors?planet=Not%20A%20Planet&radius=10').status_code == 404
+
+def test_sky_search_without_indexes(client, test_catalog):
+    """Test that cone and neighbor searches scan a catalog saved without indexes instead of returning nothing."""
+    jobs.rd.set(jobs.planet_key('Unindexed d'), json.dumps({'pl_name': 'Unindexed d', 'ra': 123.4, 'dec': -56.7, 'sy_dist': 12.0}))
+
+    response = client.get('/planets/cone?ra=123.4&dec=-56.7&radius=0.01')
+    assert 'Unindexed d' in [planet['pl_name'] for planet in response.json]
+    response = client.get('/planets/neighbors?ra=123.4&dec=-56.7&dist=12&radius=1')
+    assert 'Unindexed d' in [planet['pl_name'] for planet in response.json]
+
 def test_list_unique_stars(client):
     """Test listing unique stars."""
     response = client.get('/stars')
@@ -53,4 +178,37 @@ def test_create_job(client):
         "organize_by": "Mass"
     }
     response = client.post('/jobs', json=job_data)
-    assert response.status_code == 200
\ No newline at end of file
+    assert response.status_code == 200
+
+def test_create_density_job(client):
+    """Test 2D density job submission and rejection of an invalid axis."""
+    job_data = {
+        "start_date": "2010",
+        "end_date": "2020",
+        "organize_by": "Mass",
+        "y_axis": "Radius",
+        "log_scale": True
+    }
+    response = client.post('/jobs', json=job_data)
+    assert response.status_code == 200
+    assert response.json['y_axis'] == 'Radius'
+
+    job_data['log_scale'] = 'false'
+    response = client.post('/jobs', json=job_data)
+    assert response.json['log_scale'] == False
+
+    job_data['log_scale'] = 'sometimes'
+    response = client.post('/jobs', json=job_data)
+    assert response.json == {}
+
+    job_data['log_scale'] = True
+    job_data['y_axis'] = 'Color'
+    response = client.post('/jobs', json=job_data)
+    assert response.json == {}
+
+def test_create_job_backpressure(client, monkeypatch):
+    """Test that jobs are refused with a Retry-After header once the queue is full."""
+    monkeypatch.setattr(jobs, 'MAX_QUEUE_DEPTH', 0)
+    response = client.post('/jobs', json={"start_date": "2010", "end_date": "2020"})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
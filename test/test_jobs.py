@@ -1,13 +1,75 @@
 import pytest
 import time
+import redis
+import jobs
 from jobs import add_job
+from jobs import _parse_endpoints, _pick_reader, _read, _endpoint, _replica_health, rd, idx
+from jobs import estimate_job_cost, job_lane
 from jobs import get_job_by_id
+from jobs import save_planets, get_planet, index_generation, catalog_size, cone_search, neighbor_search
 from jobs import update_job_status
 
+@pytest.fixture
+def test_catalog(monkeypatch):
+    """Keep the planets and indexes a test saves under their own key prefixes, away from the real catalog."""
+    monkeypatch.setattr(jobs, 'PLANET_PREFIX', jobs.PLANET_PREFIX + 'test:planet:')
+    monkeypatch.setattr(jobs, 'INDEX_PREFIX', jobs.INDEX_PREFIX + 'test:idx:')
+    yield
+    jobs.delete_planets()
+
 def test_add_job():
     assert isinstance(add_job(0, 0), dict) == True
     assert isinstance(add_job(0, 0, "Radius"), dict) == True
 
+def test_save_planets_swaps_generation(test_catalog):
+    save_planets({'Old b': {'pl_name': 'Old b', 'hostname': 'Old'}})
+    first = index_generation()
+    save_planets({'New b': {'pl_name': 'New b', 'hostname': 'New'}})
+
+    assert index_generation() != first
+    assert catalog_size() == 1
+    assert get_planet('Old b') is None
+    assert get_planet('New b')['hostname'] == 'New'
+    assert not idx.keys(f'*{first}:*')
+
+def test_sky_searches_use_indexes(test_catalog, monkeypatch):
+    positions = {'Across b': (359.5, 10, 20), 'Near b': (1.5, 11, 20.5), 'Outside b': (5, 10, 20),
+                 'Pole b': (180, 89.5, 300), 'Below pole b': (90, 88, 300), 'Far b': (1.6, 11, 80)}
+    save_planets({name: {'pl_name': name, 'ra': ra, 'dec': dec, 'sy_dist': dist}
+                  for name, (ra, dec, dist) in positions.items()})
+
+    def scan(*args, **kwargs):
+        raise AssertionError('searches must read the indexes rather than scan the catalog')
+    monkeypatch.setattr(jobs, 'iter_planets', scan)
+
+    # Cones across RA 0 and over the north pole
+    assert [planet['pl_name'] for planet in cone_search(0.5, 10, 2)] == ['Across b', 'Near b', 'Far b']
+    assert [planet['pl_name'] for planet in cone_search(0, 89, 2)] == ['Pole b']
+
+    neighbors = neighbor_search(359.5, 10, 20, 5)
+    assert [planet['pl_name'] for planet in neighbors] == ['Across b', 'Near b', 'Outside b']
+    assert neighbors[0]['separation_pc'] == pytest.approx(0, abs=1e-9)
+
+def test_job_priority():
+    test_dict = add_job(2000, 2001, client='test')
+    assert test_dict['priority'] == 'interactive'
+    assert test_dict['client'] == 'test'
+
+    assert estimate_job_cost(2000, 2009) < estimate_job_cost(2000, 2009, 'Mass') < estimate_job_cost(2000, 2009, 'Mass', 'Radius')
+    assert job_lane(estimate_job_cost(1990, 2024, 'Mass')) == 'batch'
+    assert job_lane(estimate_job_cost(2000, 2001), 'batch') == 'batch'
+
+def test_queue_depth_limit(monkeypatch):
+    # The enqueue script refuses the job itself, even when the API's admission check was passed
+    monkeypatch.setattr(jobs, 'MAX_QUEUE_DEPTH', 0)
+    assert add_job(2000, 2001) is None
+
+def test_add_density_job():
+    test_dict = add_job(2000, 2020, "Mass", y_axis="Radius", log_scale=True, bins=30)
+    assert test_dict['y_axis'] == 'Radius'
+    assert test_dict['log_scale'] == True
+    assert test_dict['bins'] == 30
+
 def test_get_job_by_id():
     test_dict = add_job(2000, 2020)
     test_id = test_dict['id']
@@ -16,7 +78,10 @@ def test_get_job_by_id():
     time.sleep(10)
     
     test_dict['status'] = 'completed'
-    assert get_job_by_id(test_id) == test_dict
+    job_dict = get_job_by_id(test_id)
+    # The worker also records when the job started and how long it was queued
+    assert job_dict['queue_wait'] >= 0
+    assert {key: job_dict[key] for key in test_dict} == test_dict
     
 
     assert get_job_by_id('test') == "Job not found\n"
@@ -31,3 +96,31 @@ def test_update_job_status():
 
     with pytest.raises(Exception):
         update_job_status('test', 'testing')
+
+def test_parse_endpoints():
+    assert _parse_endpoints('') == []
+    assert _parse_endpoints('replica-1:6380, replica-2') == [('replica-1', 6380), ('replica-2', 6379)]
+
+def test_pick_reader():
+    # Nothing listens on port 1, so reads fall back to the primary
+    unavailable = redis.Redis(host='127.0.0.1', port=1, socket_connect_timeout=1)
+    assert _pick_reader(rd, [unavailable]) is rd
+    assert _pick_reader(rd, []) is rd
+
+    # Other clients for the same running instance stand in for replicas, reporting whether they are in sync
+    kwargs = rd.connection_pool.connection_kwargs
+    # (the syncing one uses another db so its cached health is kept apart)
+    syncing = redis.Redis(host=kwargs['host'], port=kwargs['port'], db=kwargs['db'] + 10)
+    syncing.info = lambda section=None: {'role': 'slave', 'master_link_status': 'down', 'master_sync_in_progress': 1}
+    assert _pick_reader(rd, [syncing]) is rd
+
+    replica = redis.Redis(host=kwargs['host'], port=kwargs['port'], db=kwargs['db'])
+    replica.info = lambda section=None: {'role': 'slave', 'master_link_status': 'up', 'master_sync_in_progress': 0}
+    assert _pick_reader(rd, [unavailable, replica]) is replica
+
+def test_read_falls_back_to_primary():
+    # A replica that was healthy at its last check but has since gone away
+    dead = redis.Redis(host='127.0.0.1', port=1, socket_connect_timeout=1)
+    _replica_health[_endpoint(dead)] = (True, time.monotonic())
+    assert _read(rd, [dead], lambda client: client.ping() and client) is rd
+    assert _replica_health[_endpoint(dead)][0] is False
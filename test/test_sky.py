@@ -0,0 +1,33 @@
+import math
+import random
+from sky import sky_cell, cone_cells, angular_separation, cartesian, space_cell, sphere_cells
+
+def test_angular_separation():
+    assert angular_separation(10, 20, 10, 20) == 0
+    assert abs(angular_separation(0, 0, 90, 0) - 90) < 1e-9
+    assert abs(angular_separation(359.5, 0, 0.5, 0) - 1) < 1e-9
+    assert abs(angular_separation(0, 89, 180, 89) - 2) < 1e-9
+
+def test_cone_cells_cover_cone():
+    """Every point inside a cone must fall in one of the cone's cells, including near the poles and RA 0."""
+    rng = random.Random(32)
+    for ra, dec, radius in [(0.2, 0, 1), (359.9, 45, 3), (120, 88.5, 2), (200, -89.9, 0.5), (45, 60, 20), (10, -30, 0.01)]:
+        cells = set(cone_cells(ra, dec, radius))
+        width = min(180, 2 * radius / max(math.cos(math.radians(abs(dec) + radius)), 0.01))
+        inside = 0
+        for _ in range(2000):
+            point_ra = (ra + rng.uniform(-width, width)) % 360
+            point_dec = rng.uniform(max(dec - radius, -90), min(dec + radius, 90))
+            if angular_separation(ra, dec, point_ra, point_dec) <= radius:
+                inside += 1
+                assert sky_cell(point_ra, point_dec) in cells
+        assert inside > 100
+
+def test_sphere_cells_cover_sphere():
+    rng = random.Random(32)
+    centre = cartesian(83.8, -5.4, 400)
+    cells = set(sphere_cells(centre, 60))
+    for _ in range(2000):
+        point = tuple(coordinate + rng.uniform(-60, 60) for coordinate in centre)
+        if sum((a - b) ** 2 for a, b in zip(point, centre)) <= 60 ** 2:
+            assert space_cell(point) in cells
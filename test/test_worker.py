@@ -4,6 +4,14 @@ import time
 
 post_response = requests.post('http://127.0.0.1:5000/data')
 
+# The catalog is ingested by a worker, so wait for the ingest job (or the one already running) to finish
+ingest_id = post_response.json()['id']
+for _ in range(600):
+    ingest_response = requests.get('http://127.0.0.1:5000/jobs/' + ingest_id)
+    if ingest_response.json().get('status') in ('completed', 'failed'):
+        break
+    time.sleep(1)
+
 dictionary = {'start_date': '2000', 'end_date': '2001'}
 job_response = requests.post('http://127.0.0.1:5000/jobs', json=dictionary)
 job_id = job_response.json()['id']
@@ -17,6 +25,11 @@ invalid_results_response = requests.get('http://127.0.0.1:5000/results/0')
 delete_response = requests.delete('http://127.0.0.1:5000/data')
 
 def test_jobs_and_worker():
+    assert post_response.status_code in (200, 409)
+    assert ingest_response.json()['job_type'] == 'ingest'
+    assert ingest_response.json()['status'] == 'completed'
+    assert ingest_response.json()['rows_written'] > 0
+
     assert job_response.status_code == 200
     assert isinstance(job_response.json(), dict) == True
 